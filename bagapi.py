@@ -19,443 +19,378 @@
 #                                 INITIATION PHASE
 # ==================================================================================
 
-# Import the required libraries
+# Import the required libraries. The pipeline itself lives in bagenrich.py, so
+# other python code can use it too (importing this file does nothing either).
 
-import requests # More information at https://realpython.com/python-requests/
 import csv # More information at https://realpython.com/python-csv/
-import config
+from bagenrich import Enricher
+from bagjournal import RunJournal, JOURNAL_VERSION, fingerprint_file
+from bagoutput import OutputWriter
+from bagdelta import PreviousRun
+from bagshard import get_shard, merge_shards, parse_shard, shard_filename
+import argparse
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 from datetime import datetime
 
-# Init logging (source: https://stackoverflow.com/a/24507130/20928224)
-if not os.path.exists("logs"):
-    os.makedirs("logs")
+def setup_logging(run_time, shard=None):
+
+  # Init logging (source: https://stackoverflow.com/a/24507130/20928224)
+  if not os.path.exists("logs"):
+      os.makedirs("logs")
+
+  log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+
+  # File to log to
+  logFile = run_time.strftime('logs/info_%H_%M_%d_%m_%Y.log')
+
+  # Shards can run at the same time, every shard gets its own log file
+  if shard is not None:
+    logFile = shard_filename(logFile, *shard)
+
+  # Setup File handler
+  file_handler = logging.FileHandler(logFile)
+  file_handler.setFormatter(log_formatter)
+  file_handler.setLevel(logging.INFO)
+
+  # Setup Stream Handler (i.e. console)
+  stream_handler = logging.StreamHandler()
+  stream_handler.setFormatter(log_formatter)
+  stream_handler.setLevel(logging.INFO)
+
+  # Get the logger
+  app_log = logging.getLogger('root')
+  app_log.setLevel(logging.INFO)
+
+  # Log lines are put in a queue, and written to both handlers by a thread of
+  # their own, so the main loop never waits for the disk or the console
+  log_queue = queue.SimpleQueue()
+  app_log.addHandler(logging.handlers.QueueHandler(log_queue))
+  listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+  listener.start()
+
+  # Write what is left in the queue when the program stops
+  atexit.register(listener.stop)
+
+def main():
+
+  import config
+
+  # Command line options
+  parser = argparse.ArgumentParser(description="Looks up the BAG data of the addresses in input.csv and writes it to output.csv.")
+  parser.add_argument('--resume', action='store_true', help="continue an interrupted run where it stopped")
+  parser.add_argument('--serve', action='store_true', help="keep running as a local service that enriches rows sent to it")
+  parser.add_argument('--host', default="127.0.0.1", help="address the service listens on")
+  parser.add_argument('--port', type=int, default=8080, help="port the service listens on")
+  parser.add_argument('--shard', metavar="K/N", help="only do the rows of shard K of N, to merge later")
+  parser.add_argument('--merge', metavar="N", type=int, help="merge the journals of N shards into one output")
+  parser.add_argument('--delta', metavar="JOURNAL", help="take the rows of a previous run from its journal, only look up new addresses")
+  args = parser.parse_args()
+
+  # Shard of input.csv to do, None is all rows
+  shard = None
+  if args.shard is not None:
+    try:
+      shard = parse_shard(args.shard)
+    except ValueError as e:
+      parser.error(str(e))
+  if args.merge is not None and (args.merge < 1 or args.resume or shard is not None or args.delta is not None):
+    parser.error("--merge needs a number of shards, and can't be combined with --resume, --shard or --delta")
+
+  # The run report is written next to the log file
+  run_time = datetime.now()
+  reportFile = run_time.strftime('logs/report_%H_%M_%d_%m_%Y.json')
+  if shard is not None:
+    reportFile = shard_filename(reportFile, *shard)
+  setup_logging(run_time, shard)
+
+  logging.info("New run started")
+
+  # Prometheus textfile with the measurements of the last run ("" turns it off)
+  metrics_file = getattr(config, 'metrics_file', "logs/bagapi.prom")
+  if shard is not None and metrics_file != "":
+    metrics_file = shard_filename(metrics_file, *shard)
+
+  # Local BAG extract to use instead of the BAG api ("" is use the api)
+  offline_extract = getattr(config, 'offline_extract', "")
+
+  # Check config (no api key is needed when using a local BAG extract)
+  if (config.api_key == "" and offline_extract == "") or config.api_base_url == "" or config.csv_delimiter == "":
+    logging.info("Fatal error: Invalid configuration in config.py.")
+
+    # Quit app
+    return
+
+  # Journal of the processed rows, needed to resume a run ("" turns it off)
+  journal_file = getattr(config, 'journal_file', "output.journal")
+
+  # Shards are merged from their journals
+  if (shard is not None or args.merge is not None) and journal_file == "":
+    logging.info("Fatal error: shards need a journal_file in config.py.")
+
+    # Quit app
+    return
+
+  # Serve jobs instead of doing input.csv
+  if args.serve:
+    from bagservice import serve
+    serve(config, args.host, args.port)
+    return
+
+  # Sessions, cache, rate limiter and worker threads for both api's
+  enricher = Enricher(config)
 
-log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
-
-# File to log to
-logFile = datetime.now().strftime('logs/info_%H_%M_%d_%m_%Y.log')
-
-# Setup File handler
-file_handler = logging.FileHandler(logFile)
-file_handler.setFormatter(log_formatter)
-file_handler.setLevel(logging.INFO)
-
-# Setup Stream Handler (i.e. console)
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(log_formatter)
-stream_handler.setLevel(logging.INFO)
-
-# Get the logger
-app_log = logging.getLogger('root')
-app_log.setLevel(logging.INFO)
-
-# Add both Handlers
-app_log.addHandler(file_handler)
-app_log.addHandler(stream_handler)
-
-logging.info("New run started")
-
-# Check config
-if config.api_key == "" or config.api_base_url == "" or config.csv_delimiter == "":
-  logging.info("Fatal error: Invalid configuration in config.py.")
-
-  # Quit app
-  quit()
-
-# Declare output
-output_rows = []
-output_failures = []
-output_skips = []
-
-# ==================================================================================
-#                                    FILE PHASE
-# ==================================================================================
-
-# Open input.csv
-with open('input.csv', newline='') as csvfile:
-
-  reader = csv.DictReader(csvfile, delimiter=config.csv_delimiter)
-  # Read it's content
-  data = list(reader)
-
-# ==================================================================================
-#                                    DATA PHASE
-# ==================================================================================
-
-# Declare helper variables
-row_count = len(data)
-row_index = -1
+  # ==================================================================================
+  #                                    FILE PHASE
+  # ==================================================================================
 
-# Log info
-logging.info("Input file has been read.")
-logging.info("- Read {0} rows".format(row_count))
+  # Open input.csv
+  input_file = open('input.csv', newline='')
+
+  # Count the rows first, without keeping them in memory
+  reader = csv.DictReader(input_file, delimiter=config.csv_delimiter)
+  row_count = 0
+  shard_row_count = 0
+  first_row = None
+  for row in reader:
+    if first_row is None:
+      first_row = row
+    row_count += 1
+    if shard is not None and get_shard(row, shard[1]) == shard[0]:
+      shard_row_count += 1
+
+  # Go back to the start, the rows are read one by one while processing them
+  input_file.seek(0)
+  data = csv.DictReader(input_file, delimiter=config.csv_delimiter)
 
-# Check for valid data
-if row_count == 0:
-  
-  # No data has been found
-  logging.info("- Fatal error: no data found in input.csv")
+  # ==================================================================================
+  #                                    DATA PHASE
+  # ==================================================================================
 
-  # Can't do anything now, quit program
-  quit()
-if row_count > 0 and data[0].get('huisnummer', '') == "":
+  # Log info
+  logging.info("Input file has been read.")
+  logging.info("- Read {0} rows".format(row_count))
+  if shard is not None:
+    logging.info("- Doing shard {0} of {1}: {2} of those rows".format(shard[0], shard[1], shard_row_count))
 
-  # Something is wrong with the data
-  logging.info("- Fatal error: 'huisnummer' column is missing. Did you specify the right csv delimiter?".format(row_count))
+  # Check for valid data
+  if row_count == 0:
 
-  # Can't do anything now, quit program
-  quit()
+    # No data has been found
+    logging.info("- Fatal error: no data found in input.csv")
 
-# Loop through each row in the csv
+    # Can't do anything now, quit program
+    enricher.close()
+    return
+  if row_count > 0 and first_row.get('huisnummer', '') == "":
 
-for row in data:
+    # Something is wrong with the data
+    logging.info("- Fatal error: 'huisnummer' column is missing. Did you specify the right csv delimiter?".format(row_count))
 
-  row_index += 1
-  logging.info('Processing row {0}/{1} ({2}%)'.format(row_index+1, row_count, round(row_index/row_count*100)))
+    # Can't do anything now, quit program
+    enricher.close()
+    return
 
   # ==================================================================================
-  #                                    SEARCH FOR ADRES
+  #                                    MAIN LOOP
   # ==================================================================================
 
-  # Add all the parameters based on conditions
-  params = {}
-
-  if row.get('postcode', '') != "":
+  # What the journal is of, a journal is only resumed (or merged) with the same
+  journal_header = {
+    'journal': JOURNAL_VERSION,
+    'input': fingerprint_file('input.csv'),
+    'rows': row_count,
+    'skip_perceel': config.skip_perceel
+  }
+
+  # A shard has its own journal and output, next to the ones of a normal run
+  output_basename = "output"
+  if shard is not None:
+    journal_header['shard'] = list(shard)
+    journal_file = shard_filename(journal_file, *shard)
+    output_basename = shard_filename(output_basename, *shard)
+
+  # The journals of all shards have to be there to merge them
+  shard_journals = {}
+  if args.merge is not None:
+    for merged_shard in range(1, args.merge + 1):
+      shard_journals[merged_shard] = RunJournal(shard_filename(journal_file, merged_shard, args.merge))
+      if shard_journals[merged_shard].read_header() != dict(journal_header, shard=[merged_shard, args.merge]):
+        logging.info("Fatal error: {0} is missing, or is not a journal of shard {1} of {2} of this input.csv.".format(shard_journals[merged_shard].filename, merged_shard, args.merge))
+
+        # Quit app
+        enricher.close()
+        return
+
+    logging.info("Merging the journals of {0} shards".format(args.merge))
+
+  # Rows of a previous run, only new addresses are looked up
+  previous_run = None
+  if args.delta is not None:
+
+    previous_journal = RunJournal(args.delta)
+    previous_header = previous_journal.read_header()
+    if os.path.abspath(args.delta) == os.path.abspath(journal_file) or previous_header is None or previous_header['journal'] != JOURNAL_VERSION or previous_header['skip_perceel'] != config.skip_perceel:
+      logging.info("Fatal error: {0} is not a journal of a previous run with these settings (copy output.journal of that run to another file).".format(args.delta))
+
+      # Quit app
+      enricher.close()
+      return
+
+    previous_run = PreviousRun(previous_journal)
+    logging.info("Delta run, {0} addresses of the previous run in {1}".format(len(previous_run.outcomes), args.delta))
+
+  # Open output to be written (output.csv, or another format), rows are added
+  # to it as soon as they are done
+  try:
+    output_writer = OutputWriter(
+      output_format=getattr(config, 'output_format', "csv"),
+      delimiter=config.csv_delimiter,
+      partition_by=getattr(config, 'output_partition', ""),
+      row_group_size=getattr(config, 'parquet_row_group_size', 10000),
+      basename=output_basename
+    )
+  except (ValueError, ImportError) as e:
+    logging.info("Fatal error: can't write the output: {0}".format(e))
 
-    # Postcode is given
-    params['postcode'] = row['postcode']
-    params['huisnummer'] = row['huisnummer']
-    params['exacteMatch'] = 'true'
+    # Quit app
+    enricher.close()
+    return
 
-    query = '{0} {1}'.format(row['postcode'], row['huisnummer'])
+  job = enricher.job(write_row=output_writer.write, row_count=row_count)
 
-    # Optionally add huisnummertoevoeging
-    if row.get('huisletter', "") != "":
-      params['huisletter'] = row['huisletter']
-    if row.get('huisnummertoevoeging', "") != "":
-      params['huisnummertoevoeging'] = row['huisnummertoevoeging']
+  # Rows before this one were done in an interrupted run, except the ones that
+  # were still to be tried again
+  resume_from = 0
+  retry_rows = set()
 
-  else:
+  # Keep a journal of every row, so an interrupted run can be resumed
+  journal = None
+  if journal_file != "":
 
-    # Postcode is not given, search based on query
-    query = '{0} {1}{2}, {3}'.format(row['straat'], row['huisnummer'], row['huisnummertoevoeging'], row['stad'])
-    params['q'] = query
-
-  # Check if adress has already been processed based on postcode + huisnummer
-  is_duplicate = False
-  for output_row in output_rows:
-    a = row['postcode'] + str(row['huisnummer']) + row['huisletter'] + row['huisnummertoevoeging']
-    b = output_row['postcode'] + str(output_row['huisnummer']) + output_row['huisletter'] + output_row['huisnummertoevoeging']
-    if a == b:
-      is_duplicate = True
-      output_row['is_invoer'] = True
-      break
-
-  if is_duplicate:
-    logging.info("- Address already processed. Skipping row.")
-
-    # Stop here, and continue with next row
-    output_skips.append(row_index)
-    continue
-
-  # Search request for the adres (according to https://lvbag.github.io/BAG-API/Technische%20specificatie/#/Adres/bevraagAdressen)
-  adres_response = requests.get(
-    config.api_base_url + "adressen",
-    params=params,
-    headers={
-    'X-Api-Key': config.api_key
-    }
-  )
-
-  # Parse the data. It's a JSON response, so use that
-  adres_data = adres_response.json()
-
-  # Check if the request went well
-  if adres_response.status_code != 200:
-
-    # Something went wrong
-    logging.info('- Error: {1}'.format(row_index, adres_data['title']))
-
-    # Stop here, and continue with the next row
-    output_failures.append(row_index)
-    continue
-
-  # Check data
-
-  # _embedded column won't be there if no results are given
-  if adres_data.get('_embedded', '') == "":
-    logging.info("- Error: address {0} was not found.".format(query))
-
-    # Stop here, contiue on new row
-    output_failures.append(row_index)
-    continue
-
-  # Get some data
-  adres_object = adres_data['_embedded']['adressen'][0]
-  korteNaam = adres_object['korteNaam']
-  huisnummer = adres_object['huisnummer']
-  woonplaats = adres_object['woonplaatsNaam']
-  huisletter = adres_object.get('huisletter', '')
-  huisnummertoevoeging = adres_object.get('huisnummertoevoeging', '')
-  postcode = adres_object['postcode']
-  pandId = adres_object['pandIdentificaties'][0]
-  nummeraanduiding = adres_object['nummeraanduidingIdentificatie']
-
-  # Mechanism to check if search query found the right result
-  full_huisnummer = str(huisnummer) + huisletter.lower() + huisnummertoevoeging.lower()
-  full_huisnummer_row = row['huisnummer'] + row['huisletter'].lower() + row['huisnummertoevoeging'].lower()
-
-  # Check if pand has already been processed based on pandId
-  for output_row in output_rows:
-    if pandId == output_row['pandId']:
-      is_duplicate = True
-      output_row['is_invoer'] = True
-      break 
-
-  if is_duplicate:
-    logging.info("- Pand already processed. Skipping row.")
-
-    # Stop here, and continue with next row
-    output_skips.append(row_index)
-    continue
-
-  if full_huisnummer != full_huisnummer_row: # Is mismatch
-    logging.info("- Error: address was not found and so another address was returned by the API instead (expected huisnummer {0}, got {1}).".format(full_huisnummer_row, full_huisnummer))
-
-    # Stop here, and continue with next row
-    output_failures.append(row_index)
-    continue
+    journal = RunJournal(journal_file)
 
-  # Log info
-  friendly_address = "{0} {1}{2}{3}, {4} {5}".format(korteNaam, huisnummer, huisletter, huisnummertoevoeging, postcode, woonplaats);
-  logging.info("- Address is: " + friendly_address)
+    if args.resume:
 
-  # ==================================================================================
-  #                                    GET PAND
-  # ==================================================================================
+      found_header = journal.read_header()
+      if found_header is None:
+        logging.info("No journal found in {0}, starting at the first row.".format(journal_file))
 
-  # Get pand of adres (according to https://lvbag.github.io/BAG-API/Technische%20specificatie/#/Pand/pandIdentificatie)
-  pand_response = requests.get(
-    adres_object['_links']['panden'][0]['href'],
-    headers={
-    'X-Api-Key': config.api_key,
-    'Accept-Crs': 'epsg:28992'
-    }
-  )
+      elif found_header != journal_header:
+        logging.info("Fatal error: {0} is not a journal of this input.csv, can't resume.".format(journal_file))
 
-  # Parse json data
-  pand_data = pand_response.json()
+        # Quit app
+        enricher.close()
+        return
 
-  # Get some data
-  pandId = pand_data['pand']['identificatie']
-  bouwjaar = pand_data['pand']['oorspronkelijkBouwjaar']
-
-  logging.info("- Found pand: {0}".format(pandId))
-
-  # ==================================================================================
-  #                                   GET PERCEEL
-  # ==================================================================================
+      else:
 
-  # Init variables
-  perceel_section = ""
-  perceel_number = ""
-  perceel_size = ""
-  perceel_description = ""
-  perceel_energy = ""
-
-  # Optionally skip
-  if not config.skip_perceel:
-
-    # Body data to send with gob request
-    perceel_request_data = {
-      "bagId": nummeraanduiding,
-      "selection": [
-        {
-          "code": "buurtstatistieken",
-          "deliver": "partialProduct",
-          "purposeLimitations": []
-        }
-      ],
-      "includePdf": False
-    }
-
-    # Make request
-    perceel_response = requests.post(
-      config.gob_api_base_url + "report",
-      json = perceel_request_data,
-      headers = {
-      'X-Api-Key': config.gob_api_key
-      }
-    )
+        # Replay the rows that were done, this rebuilds output.csv and the indexes
+        replayed = 0
+        for outcome in journal.replay():
+          job.apply_outcome(outcome)
 
-    # Parse data from json
-    perceel_data = perceel_response.json()
+          # Rows tried again come after the other rows
+          if outcome['outcome'] == 'retry':
+            retry_rows.add(outcome['row'])
+          else:
+            retry_rows.discard(outcome['row'])
+            replayed += 1
+          resume_from = max(resume_from, outcome['row'] + 1)
 
-    if perceel_response.status_code != 200:
-      # Something went wrong
-      logging.info("- GOB API error on bagId \"{0}\": \"{1}\"".format(nummeraanduiding, perceel_data['message']))
+        logging.info("Resuming at row {0}, {1} rows were done before.".format(resume_from + 1, replayed))
 
-    else:
+    journal.open(journal_header, append=resume_from > 0)
 
-      if 'general' in perceel_data['document']:
+  elif args.resume:
+    logging.info("Fatal error: resuming needs a journal_file in config.py.")
 
-        # Take data needed
-        perceelaanduiding = perceel_data['document']['general']['kadastraleAanduiding']['kadastraleAanduiding']
-        perceel_section = perceelaanduiding.split()[1]
-        perceel_number = perceelaanduiding.split()[2]
-        perceel_size = float(perceel_data['document']['general']['size'])
-        perceel_description = perceel_data['document']['general']['omschrijving']
-        perceel_energy = perceel_data['document']['general']['energieLabel']
+    # Quit app
+    enricher.close()
+    return
 
-        # If no energielabel, make it empty instead of given text
-        if "geen energielabel" in perceel_energy:
-          perceel_energy = ""
+  def finish_outcome(outcome):
 
-      else:
+    # Make sure the row is on disk before going to the next one
+    output_writer.flush()
+    if journal is not None:
+      journal.write(outcome)
 
-        logging.info("- Perceel data for bagId \"{0}\" was not given".format(nummeraanduiding))
+  if args.merge is not None:
 
+    # The rows come from the journals of the shards, not from the api's
+    try:
+      merge_shards(job, data, shard_journals, on_outcome=finish_outcome)
+    except ValueError as e:
+      logging.info("Fatal error: can't merge, {0}.".format(e))
 
-  # ==================================================================================
-  #                           GET VERBLIJFSOBJECTEN AT PAND
-  # ==================================================================================
+      # Quit app
+      input_file.close()
+      output_writer.close()
+      journal.close()
+      enricher.close()
+      return
 
-  # Get verblijfsobjecten of pand (according to https://lvbag.github.io/BAG-API/Technische%20specificatie/#/Verblijfsobject/zoekVerblijfsobjecten)
-  verblijfsobjecten_page = 0
-  verblijfsobjecten_count = 0
-
-  # Create seamingly infinite loop that gets broken where needed
-  while True:
-
-    verblijfsobjecten_page += 1
-
-    verblijfsobjecten_response = requests.get(
-      config.api_base_url + "verblijfsobjecten",
-      params={
-      'pandIdentificatie': pandId,
-      'expand': 'heeftAlsHoofdAdres',
-      'pageSize': 100, # Maximum of verblijfsobjecten per call
-      'page': verblijfsobjecten_page
-      },
-      headers={
-      'X-Api-Key': config.api_key,
-      'Accept-Crs': 'epsg:28992'
-      }
-    )
+  else:
 
-    # Parse the data
-    verblijfsobjecten_data = verblijfsobjecten_response.json()
-
-    # If _embedded column, there were no objects on this 'page'
-    if verblijfsobjecten_data.get('_embedded', '') == "":
-      # Decrease page for logging
-      verblijfsobjecten_page -= 1
-      break
-
-    verblijfsobjecten = verblijfsobjecten_data['_embedded']['verblijfsobjecten']
-    verblijfsobjecten_count += len(verblijfsobjecten)
-
-    # Data to be extracted:
-    #
-    # - Postcode
-    # - PandID
-    # - Bouwjaar
-    #
-    # For every verblijfsobject:
-    #
-    # - Verblijfsobject ID
-    # - Huisnummer
-    # - Oppervlakte
-    # - Gebruiksdoel
-    # - Status
-
-    if verblijfsobjecten_count == 1: # Pand contains only a single verblijfsobject
-
-        verblijfsobject = verblijfsobjecten[0]['verblijfsobject']
-        output_rows.append({
-        'postcode': postcode,
-        'straat': korteNaam,
-        'woonplaats': woonplaats,
-        'pandId': pandId,
-        'bouwjaar': bouwjaar,
-        'sectie': perceel_section,
-        'perceelnummer': perceel_number,
-        'perceeloppervlakte': perceel_size,
-        'perceelomschrijving': perceel_description,
-        'perceel_energielabel': perceel_energy,
-        'huisnummer': huisnummer,
-        'huisletter': huisletter,
-        'huisnummertoevoeging': huisnummertoevoeging,
-        'verblijfsobjectId': verblijfsobject['identificatie'],
-        'oppervlakte': verblijfsobject['oppervlakte'],
-        'gebruiksdoel': verblijfsobject['gebruiksdoelen'][0],
-        'status': verblijfsobject['status'],
-        'is_invoer': True
-      })
-        
-    if verblijfsobjecten_count > 1: # Pand contains multiple verblijfsobjecten
-
-      # Loop through each verblijfsobject in pand
-      for verblijfsobject in verblijfsobjecten:
-
-        # Write data to file
-        output_rows.append({
-          'postcode': verblijfsobject['_embedded']['heeftAlsHoofdAdres']['nummeraanduiding'].get('postcode', ''),
-          'straat': korteNaam,
-          'woonplaats': woonplaats,
-          'pandId': pandId,
-          'bouwjaar': bouwjaar,
-          'sectie': perceel_section,
-          'perceelnummer': perceel_number,
-          'perceeloppervlakte': perceel_size,
-          'perceelomschrijving': perceel_description,
-          'perceel_energielabel': perceel_energy,
-          'huisnummer': verblijfsobject['_embedded']['heeftAlsHoofdAdres']['nummeraanduiding'].get('huisnummer', ''),
-          'huisletter': verblijfsobject['_embedded']['heeftAlsHoofdAdres']['nummeraanduiding'].get('huisletter', ''),
-          'huisnummertoevoeging': verblijfsobject['_embedded']['heeftAlsHoofdAdres']['nummeraanduiding'].get('huisnummertoevoeging', ''),
-          'verblijfsobjectId': verblijfsobject['verblijfsobject'].get('identificatie', ''),
-          'oppervlakte': verblijfsobject['verblijfsobject'].get('oppervlakte', ''),
-          'gebruiksdoel': verblijfsobject['verblijfsobject'].get('gebruiksdoelen', [])[0],
-          'status': verblijfsobject['verblijfsobject'].get('status', ''),
-        })
-
-        # Add column that indicates that a row was the original address
-        full_verblijfsobject_huisnummer_row = str(output_rows[-1].get('huisnummer', '')) + output_rows[-1].get('huisnummertoevoeging', '').lower()
-        output_rows[-1]['is_invoer'] = full_verblijfsobject_huisnummer_row == full_huisnummer
-
-    # If count is not multiple of 100, there is probably more, 
-    #   so continue loop to process next page.
-    # Else, nothing to fetch so break the loop
-    if verblijfsobjecten_count % 100 != 0:
-      break
-
-  logging.info("- Found {0} verblijfsobjecten at pand (spread over {1} pages)".format(verblijfsobjecten_count, verblijfsobjecten_page))
+    # Only the rows of the shard, when doing a shard
+    row_filter = None
+    if shard is not None:
+      row_filter = lambda row: get_shard(row, shard[1]) == shard[0]
 
-# ==================================================================================
-#                                 OUTPUT PHASE
-# ==================================================================================
+    job.run(data, start=resume_from, on_outcome=finish_outcome, row_filter=row_filter, previous_run=previous_run, retry_rows=retry_rows)
 
-# Open file to be written
-with open('output.csv', 'w', newline='') as csvfile:
-    
-    # Define what params should be written to output csv
-    fieldnames = ['postcode', 'huisnummer', 'huisletter', 'huisnummertoevoeging', 'straat', 'woonplaats', 'pandId', 'bouwjaar', 'verblijfsobjectId', 'oppervlakte', 'gebruiksdoel', 'status', 'is_invoer', 'sectie', 'perceelnummer', 'perceeloppervlakte', 'perceelomschrijving', 'perceel_energielabel']
+  enricher.close()
 
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore', delimiter=config.csv_delimiter)
+  # ==================================================================================
+  #                                 OUTPUT PHASE
+  # ==================================================================================
 
-    # Write header line & all the rows
-    writer.writeheader()
-    writer.writerows(output_rows)
+  # All rows are read and written
+  input_file.close()
+  output_writer.close()
+  if journal is not None:
+    journal.close()
 
-# Log info
-logging.info("Processing done (100%)")
-logging.info("- Written {0} csv rows (Input: {1} failed & {2} skipped duplicates)".format(len(output_rows), len(output_failures), len(output_skips)))
+  # Rows that became is_invoer after they were written still have to be fixed.
+  # The output files they are in are copied, changing those rows along the way.
+  output_writer.patch_invoer(job.invoer_patches)
 
-# Log failed rows
-if len(output_failures) > 0:
-  logging.info("- Failed input row number(s): " + ", ".join(map(lambda a : str(a+1),output_failures)))
+  # Log info
+  logging.info("Processing done (100%)")
+  logging.info("- Written {0} {1} rows (Input: {2} failed & {3} skipped duplicates)".format(job.output_row_count, output_writer.output_format, len(job.output_failures), len(job.output_skips)))
+  if shard is not None:
+    logging.info("- Merge it with the other shards with: bagapi.py --merge {0}".format(shard[1]))
+  if output_writer.path() != "output.csv":
+    logging.info("- Output written to {0}".format(output_writer.path()))
+
+  # Log connection reuse, requests saved, rates and cache use
+  for summary in enricher.summary():
+    logging.info("- " + summary)
+  if previous_run is not None:
+    logging.info("- " + previous_run.summary())
+
+  # Log failed rows
+  if len(job.output_failures) > 0:
+    logging.info("- Failed input row number(s): " + ", ".join(map(lambda a : str(a+1),job.output_failures)))
+
+  # Write the run report, and the metrics for Prometheus
+  run_report = enricher.metrics.report({
+    'input': shard_row_count if shard is not None else row_count,
+    'output': job.output_row_count,
+    'failed': len(job.output_failures),
+    'skipped': len(job.output_skips)
+  })
+  enricher.metrics.write_json(reportFile, run_report)
+  if metrics_file != "":
+    enricher.metrics.write_prometheus(metrics_file, run_report)
+  logging.info("- Run report written to {0}".format(reportFile))
+
+if __name__ == '__main__':
+  main()
 
 # ==================================================================================
 #                                       EPILOGUE
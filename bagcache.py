@@ -0,0 +1,143 @@
+# ==================================================================================
+#                                  RESPONSE CACHE
+# ==================================================================================
+
+# Most runs are done over (almost) the same addresses as the run before. The
+# answers of the api's are stored in a small SQLite database, so a re-run can
+# take them from disk instead of asking the api again.
+#
+# Every endpoint has its own time to live, after which a response is fetched
+# again. When the database grows over its maximum size, the responses that
+# were used the longest time ago are removed first.
+
+import json
+import sqlite3
+import threading
+import time
+from hashlib import sha1
+
+# Seconds in a day, the time to live is configured in days
+DAY = 24 * 60 * 60
+
+# Time to live in days for endpoints that are not in the configuration
+DEFAULT_TTL_DAYS = {
+  'adressen': 7,
+  'panden': 30,
+  'verblijfsobjecten': 7,
+  'report': 30
+}
+
+class CachedResponse:
+
+  # Looks enough like a requests response for the code that reads it
+  def __init__(self, status_code, content):
+    self.status_code = status_code
+    self.content = content
+
+  def json(self):
+    return json.loads(self.content)
+
+class ResponseCache:
+
+  def __init__(self, filename, ttl_days, max_mb):
+
+    self.ttl_days = dict(DEFAULT_TTL_DAYS)
+    self.ttl_days.update(ttl_days)
+    self.max_size = max_mb * 1024 * 1024
+
+    # Hits and misses per endpoint, for the run summary
+    self.hits = {}
+    self.misses = {}
+
+    # The connection is shared between the worker threads
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("""
+      CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        endpoint TEXT NOT NULL,
+        status INTEGER NOT NULL,
+        body BLOB NOT NULL,
+        created REAL NOT NULL,
+        used REAL NOT NULL
+      )
+    """)
+    self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+
+    self.size = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+
+  def make_key(self, method, url, params=None, body=None):
+
+    # Same request with the parameters in another order (or with other
+    # types, like 12 and "12") should give the same key
+    normalized_params = sorted((str(name), str(value).strip()) for name, value in (params or {}).items())
+    key = json.dumps([method, url, normalized_params, body], sort_keys=True)
+
+    return sha1(key.encode('utf-8')).hexdigest()
+
+  def get(self, endpoint, key):
+
+    now = time.time()
+    ttl = self.ttl_days.get(endpoint, 0) * DAY
+
+    with self.lock:
+      found = self.db.execute("SELECT status, body, created FROM responses WHERE key = ?", (key,)).fetchone()
+
+      # Not there, or too old to use
+      if found is None or found[2] + ttl < now:
+        self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+        return None
+
+      self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+      self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+
+    return CachedResponse(found[0], found[1])
+
+  def put(self, endpoint, key, status_code, content):
+
+    now = time.time()
+
+    with self.lock:
+      self.db.execute(
+        "INSERT OR REPLACE INTO responses (key, endpoint, status, body, created, used) VALUES (?, ?, ?, ?, ?, ?)",
+        (key, endpoint, status_code, content, now, now)
+      )
+      self.size += len(content)
+
+      if self.size > self.max_size:
+        self.evict()
+
+  def evict(self):
+
+    # Remove expired responses first
+    now = time.time()
+    for endpoint, ttl_days in self.ttl_days.items():
+      self.db.execute("DELETE FROM responses WHERE endpoint = ? AND created < ?", (endpoint, now - ttl_days * DAY))
+
+    # Then the least recently used ones, until there is some room again
+    self.size = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+    cursor = self.db.execute("SELECT key, LENGTH(body) FROM responses ORDER BY used")
+    evicted = []
+    while self.size > self.max_size * 0.9:
+      found = cursor.fetchone()
+      if found is None:
+        break
+      evicted.append((found[0],))
+      self.size -= found[1]
+    cursor.close()
+
+    self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+  def close(self):
+
+    with self.lock:
+      self.db.close()
+
+  def summary(self):
+
+    endpoints = sorted(set(self.hits) | set(self.misses))
+    details = ", ".join("{0}: {1} hits/{2} misses".format(endpoint, self.hits.get(endpoint, 0), self.misses.get(endpoint, 0)) for endpoint in endpoints)
+
+    return "Cache: {0} hits, {1} misses ({2})".format(sum(self.hits.values()), sum(self.misses.values()), details)
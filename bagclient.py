@@ -0,0 +1,294 @@
+# ==================================================================================
+#                                    API CLIENT
+# ==================================================================================
+
+# Every request to the BAG and GOB api goes through an ApiClient. A client
+# keeps one session per api, so the connections (and their TLS handshakes)
+# are reused between rows instead of being set up again for every request.
+#
+# Requests that fail because of a hiccup on the other side (5xx responses and
+# connection errors) are retried a few times, waiting a bit longer each time.
+#
+# When a cache is given, successful responses are stored in it and taken from
+# it the next time the same request is done.
+#
+# When a rate limiter is given, every request waits for its permission first.
+# Requests that are throttled by the api (429) are tried again after the time
+# the api asked for, instead of failing.
+#
+# When run metrics are given, the latency, status code, size and retries of
+# every request are measured.
+#
+# Every request has a timeout to connect and to read the answer, so a
+# connection that stalls can't hang the run. A request that still fails after
+# its retries (timeouts, connection errors) gives an error response, like a
+# 5xx answer would.
+#
+# Requests to hedged endpoints are sent a second time when the answer takes
+# longer than most answers of that endpoint took (a percentile of their
+# latency). The first answer is used. Only for lookups that change nothing.
+
+import json
+import requests # More information at https://realpython.com/python-requests/
+import threading
+import time
+from bagcache import CachedResponse
+from bagmetrics import Histogram
+from bagratelimit import parse_retry_after
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+# Responses that are worth another try
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+# Status code of the error response of a request that got no answer at all
+NO_RESPONSE_STATUS_CODE = 599
+
+# Seconds to connect and to read the answer, when not configured per endpoint
+DEFAULT_TIMEOUTS = {'default': (5, 30)}
+
+# Latencies an endpoint needs before its requests are hedged
+HEDGE_MIN_SAMPLES = 20
+
+class ServerErrorRetry(Retry):
+
+  # Only wait for Retry-After on server errors here, a 429 is handled by the
+  # rate limiter (which slows down all requests, not just this one)
+  RETRY_AFTER_STATUS_CODES = frozenset([503])
+
+class ApiClient:
+
+  def __init__(self, name, headers, pool_size=1, retries=3, backoff=0.5, cache=None, rate_limiter=None, rate_limit_retries=10, metrics=None, timeouts=None, hedge_endpoints=(), hedge_percentile=95):
+
+    self.name = name
+    self.metrics = metrics
+    self.cache = cache
+    self.pool_size = pool_size
+    self.rate_limiter = rate_limiter
+    self.rate_limit_retries = rate_limit_retries
+
+    # (connect, read) timeouts in seconds per endpoint, 'default' for the others
+    self.timeouts = dict(DEFAULT_TIMEOUTS)
+    self.timeouts.update(timeouts or {})
+
+    # Hedged requests, with the latencies of their endpoints to decide when.
+    # Hedging needs a thread for both requests and room for their connections.
+    self.hedge_endpoints = set(hedge_endpoints)
+    self.hedge_percentile = hedge_percentile
+    self.hedge_latencies = {endpoint: Histogram() for endpoint in self.hedge_endpoints}
+    self.hedge_executor = None
+    if len(self.hedge_endpoints) > 0:
+      self.hedge_executor = ThreadPoolExecutor(max_workers=pool_size * 2)
+      pool_size = pool_size * 2
+
+    # Counters for the run summary
+    self.request_count = 0
+    self.retry_count = 0
+    self.hedge_count = 0
+    self.hedge_win_count = 0
+    self.closed_connection_count = 0
+    self.lock = threading.Lock()
+
+    # Retry transient errors, also for POST (the GOB report does not change anything)
+    retry = ServerErrorRetry(
+      total=retries,
+      connect=retries,
+      read=retries,
+      status=retries,
+      backoff_factor=backoff,
+      status_forcelist=RETRY_STATUS_CODES,
+      allowed_methods=None,
+      raise_on_status=False
+    )
+
+    # One connection per worker thread is enough
+    self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    # Headers are the same for every request, so set them once
+    self.session = requests.Session()
+    self.session.headers.update(headers)
+    self.session.mount('https://', self.adapter)
+    self.session.mount('http://', self.adapter)
+
+  def get(self, url, params=None, endpoint=None):
+
+    return self.request('GET', url, endpoint, params=params)
+
+  def post(self, url, json=None, endpoint=None):
+
+    return self.request('POST', url, endpoint, json=json)
+
+  def request(self, method, url, endpoint, params=None, json=None):
+
+    # Only requests with a known endpoint can be cached (it decides the time to live)
+    key = None
+    if self.cache is not None and endpoint is not None:
+      key = self.cache.make_key(method, url, params, json)
+      cached_response = self.cache.get(endpoint, key)
+      if cached_response is not None:
+        if self.metrics is not None:
+          self.metrics.observe_cached(self.name, endpoint)
+        return cached_response
+
+    if endpoint in self.hedge_endpoints:
+      response = self.hedged_send(method, url, endpoint, params, json)
+    else:
+      response = self.send(method, url, endpoint, params, json)
+
+    # Errors are not stored, those should be tried again next time
+    if key is not None and response.status_code == 200:
+      self.cache.put(endpoint, key, response.status_code, response.content)
+
+    return response
+
+  def hedged_send(self, method, url, endpoint, params, json):
+
+    # Until there are enough latencies, nothing is known to be slow
+    with self.lock:
+      latencies = self.hedge_latencies[endpoint]
+      hedge_after = latencies.percentile(self.hedge_percentile) if latencies.count >= HEDGE_MIN_SAMPLES else None
+
+    if hedge_after is None or hedge_after == float('inf'):
+      return self.timed_send(method, url, endpoint, params, json)
+
+    first = self.hedge_executor.submit(self.timed_send, method, url, endpoint, params, json)
+    try:
+      return first.result(timeout=hedge_after)
+    except TimeoutError:
+      pass
+
+    # Slow, ask again and take the answer that comes first (the other one
+    # is left to finish by itself)
+    second = self.hedge_executor.submit(self.timed_send, method, url, endpoint, params, json)
+    with self.lock:
+      self.hedge_count += 1
+
+    done, pending = wait([first, second], return_when=FIRST_COMPLETED)
+    winner = second if second in done and first not in done else first
+    response = winner.result()
+
+    # An answer that is an error is not better than waiting for the other one
+    if response.status_code != 200 and len(pending) > 0:
+      response = pending.pop().result()
+      winner = second if winner is first else first
+
+    if winner is second:
+      with self.lock:
+        self.hedge_win_count += 1
+
+    return response
+
+  def timed_send(self, method, url, endpoint, params, json):
+
+    # Latency of a hedged endpoint, with waiting for the rate limiter (that
+    # is part of how long the row waits)
+    started = time.perf_counter()
+    response = self.send(method, url, endpoint, params, json)
+    with self.lock:
+      self.hedge_latencies[endpoint].observe(time.perf_counter() - started)
+
+    return response
+
+  def send(self, method, url, endpoint, params, json):
+
+    if self.rate_limiter is None:
+      return self.timed_request(method, url, endpoint, params, json)
+
+    host_limiter = self.rate_limiter.get(urlparse(url).hostname, self.pool_size)
+    attempt = 0
+
+    while True:
+
+      # Wait for our turn
+      host_limiter.acquire()
+      throttled = False
+      retry_after = None
+
+      try:
+        response = self.timed_request(method, url, endpoint, params, json)
+        throttled = response.status_code == 429
+        if throttled:
+          retry_after = parse_retry_after(response.headers.get('Retry-After'))
+      finally:
+        host_limiter.release(throttled, retry_after)
+
+      # Throttled too often, give the 429 back like any other error
+      if not throttled or attempt >= self.rate_limit_retries:
+        return response
+
+      attempt += 1
+
+  def timed_request(self, method, url, endpoint, params, json):
+
+    # Time spent waiting for the rate limiter is not part of the latency,
+    # retries are (the row has to wait for them)
+    started = time.perf_counter()
+    timeout = self.timeouts.get(endpoint, self.timeouts['default'])
+
+    try:
+      response = self.session.request(method, url, params=params, json=json, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+      return self.count_no_response(e, endpoint, time.perf_counter() - started)
+
+    return self.count(response, endpoint, time.perf_counter() - started)
+
+  def count_no_response(self, error, endpoint, seconds):
+
+    # No answer after all retries, give an error like the api's do (BAG
+    # errors have a title, GOB errors a message)
+    message = "No answer from {0}: {1}".format(self.name, type(error).__name__)
+    with self.lock:
+      self.request_count += 1
+
+    if self.metrics is not None:
+      self.metrics.observe_request(self.name, endpoint, NO_RESPONSE_STATUS_CODE, seconds, 0, 0, 0)
+
+    return CachedResponse(NO_RESPONSE_STATUS_CODE, json.dumps({'title': message, 'message': message}))
+
+  def count(self, response, endpoint, seconds):
+
+    # The retries that were needed for this response are kept in its history
+    retries = response.raw.retries
+    retry_count = len(retries.history) if retries is not None else 0
+    with self.lock:
+      self.request_count += 1
+      self.retry_count += retry_count
+
+    if self.metrics is not None:
+      self.metrics.observe_request(
+        self.name,
+        endpoint,
+        response.status_code,
+        seconds,
+        len(response.request.body or b''),
+        len(response.content),
+        retry_count
+      )
+
+    return response
+
+  def connection_count(self):
+
+    # Every host has its own pool, which counts the connections it opened
+    # (the pools are gone once the client is closed)
+    pools = self.adapter.poolmanager.pools
+    return self.closed_connection_count + sum(pools[key].num_connections for key in pools.keys())
+
+  def summary(self):
+
+    summary = "{0}: {1} requests over {2} connections ({3} retries)".format(self.name, self.request_count, self.connection_count(), self.retry_count)
+    if self.hedge_count > 0:
+      summary += ", {0} hedged ({1} answered first by the hedge)".format(self.hedge_count, self.hedge_win_count)
+
+    return summary
+
+  def close(self):
+
+    if self.hedge_executor is not None:
+      self.hedge_executor.shutdown(wait=False)
+
+    # Close the open connections, the summary still counts them
+    self.closed_connection_count = self.connection_count()
+    self.session.close()
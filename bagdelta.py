@@ -0,0 +1,96 @@
+# ==================================================================================
+#                                    DELTA RUNS
+# ==================================================================================
+
+# Most of input.csv is the same as in the run before. A delta run takes the
+# journal of that run, and only looks up the rows with an address that is not
+# in it:
+#
+#   cp output.journal previous.journal
+#   bagapi.py --delta previous.journal
+#
+# A row is the same when its address (postcode, huisnummer, huisletter and
+# huisnummertoevoeging) is the same, other columns are not used for the
+# lookup. Rows without a postcode are searched by street and city, those are
+# always looked up again. So are rows that failed with an error before, that
+# could have been a hiccup of the api.
+#
+# The outcome of a row in the previous run depends on the rows before it
+# (duplicates are skipped). The duplicate checks are done again for the new
+# input, and a row that was skipped before but is the first at its pand now
+# is looked up again (the rows of its pand have the perceel of another row).
+# So the output is the same as when every row was looked up again.
+
+from bagenrich import get_address_key
+from bagrows import as_pand_rows
+from bisect import bisect_right
+
+class PreviousRun:
+
+  def __init__(self, journal):
+
+    self.filename = journal.filename
+
+    # Outcome of every address, the first time it was in the previous run
+    self.outcomes = {}
+
+    # Addresses of the previous run that were used in this one
+    self.used = set()
+
+    # Output rows of the previous run, numbered with the pand they belong to
+    row_starts = []
+    pandIds = []
+    output_row_count = 0
+
+    for outcome in journal.replay():
+
+      pandId = outcome.get('pandId')
+
+      if outcome['outcome'] == 'rows':
+        row_starts.append(output_row_count)
+        pandIds.append(pandId)
+        output_row_count += len(outcome['rows'])
+
+        # Kept per pand, a previous run can be big
+        outcome['rows'] = as_pand_rows(outcome['rows'])
+
+      # Skips point to an output row, of the pand they are at
+      elif outcome['outcome'] == 'skip' and outcome['reason'] == 'address':
+        pandId = pandIds[bisect_right(row_starts, outcome['invoer']) - 1]
+
+      # Errors are asked again, rows that were tried again have their
+      # outcome later in the journal
+      elif outcome['outcome'] == 'retry' or (outcome['outcome'] == 'failure' and outcome['reason'] in ('error', 'deadline')):
+        continue
+
+      if outcome['key'] in self.outcomes:
+        continue
+
+      previous_outcome = {'key': outcome['key'], 'outcome': outcome['outcome']}
+      if pandId is not None:
+        previous_outcome['pandId'] = pandId
+      if outcome['outcome'] == 'rows':
+        previous_outcome['rows'] = outcome['rows']
+      elif outcome['outcome'] == 'failure':
+        previous_outcome['reason'] = outcome['reason']
+
+      self.outcomes[outcome['key']] = previous_outcome
+
+  def get(self, row):
+
+    # Outcome of the address of the row in the previous run, None when it has
+    # to be looked up
+    if row.get('postcode', '') == "":
+      return None
+
+    key = get_address_key(row)
+    outcome = self.outcomes.get(key)
+    if outcome is None:
+      return None
+
+    self.used.add(key)
+    return outcome
+
+  def summary(self):
+
+    return "Delta: {0} addresses taken from {1}, {2} of its addresses were not used".format(len(self.used), self.filename, len(self.outcomes) - len(self.used))
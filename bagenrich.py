@@ -0,0 +1,1276 @@
+# ==================================================================================
+#                                  ENRICH PIPELINE
+# ==================================================================================
+
+# The pipeline of bagapi.py, to use from other python code:
+#
+#   from bagenrich import enrich
+#
+#   for output_row in enrich(rows, config):
+#     ...
+#
+# where rows are dicts with the columns of input.csv, and config is anything
+# with the settings of config.py (the config module itself, or for example a
+# types.SimpleNamespace). Importing this module does nothing by itself: no log
+# handlers, no files and no requests.
+#
+# An Enricher holds everything that is worth keeping between jobs: the api
+# sessions (with their open connections), the response cache, the rate
+# limiter, the worker threads and the lookups that were done. An EnrichJob is
+# one input: it decides which rows are skipped as duplicates and which output
+# row is the invoer. Those indexes are never shared between jobs, a job gives
+# the same output whatever jobs were done before it.
+
+import logging
+import threading
+import time
+from bagclient import ApiClient
+from bagcache import ResponseCache
+from bagmetrics import RunMetrics
+from bagnormalize import INPUT_COLUMNS, normalize_row, swap_huisletter
+from bagoffline import BagExtract, OfflineClient
+from bagoutput import SCHEMA
+from bagratelimit import RateLimiter
+from bagrows import PandRows, RowStore, make_pand, make_unit
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError
+from urllib.parse import urlparse, parse_qs
+
+log = logging.getLogger('bagapi')
+
+# Define what params should be written to output (with their types in SCHEMA)
+fieldnames = [name for name, kind in SCHEMA]
+
+def get_address_key(row):
+
+  # Key used to check if an address has already been processed (or is being
+  # looked up), of a normalized row (see bagnormalize.py). Letters count in
+  # any case. Rows without postcode are searched by street and city.
+  if row.get('postcode', '') == "":
+    return "{0} {1}{2}{3}, {4}".format(row.get('straat', ''), row.get('huisnummer', ''), row.get('huisletter', ''), row.get('huisnummertoevoeging', ''), row.get('stad', '')).upper()
+
+  return (row['postcode'] + str(row.get('huisnummer', '')) + row.get('huisletter', '') + row.get('huisnummertoevoeging', '')).upper()
+
+def format_duration(seconds):
+
+  # 3725 seconds is 1h02m, for the progress line
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  if hours > 0:
+    return "{0}h{1:02d}m".format(hours, minutes)
+  if minutes > 0:
+    return "{0}m{1:02d}s".format(minutes, seconds)
+  return "{0}s".format(seconds)
+
+def get_link_page(links, name):
+
+  # Page number of a HAL link ('next', 'last'), None when there is no such link
+  link = links.get(name)
+  if not isinstance(link, dict) or 'href' not in link:
+    return None
+
+  page = parse_qs(urlparse(link['href']).query).get('page', [''])[0]
+  return int(page) if page.isdigit() else None
+
+# ==================================================================================
+#                                  LOOKUP FUNCTIONS
+# ==================================================================================
+
+# All the waiting on the APIs happens in the functions below. They are run by a
+# pool of worker threads, so many rows can be in flight at the same time.
+#
+# Worker threads only fetch data, they never touch the output. All the
+# bookkeeping (skips, failures, is_invoer) is done by the thread running the
+# job, row by row and in the order of the input, so the result is exactly the
+# same as when the rows would have been processed one after another.
+
+class Enricher:
+
+  def __init__(self, config, metrics=None, lookup_memory=0, lookup_max_age=3600):
+
+    self.config = config
+
+    # Measurements of requests and phases, for the run report
+    self.metrics = metrics if metrics is not None else RunMetrics()
+
+    # Finished pand and perceel lookups kept for later jobs (0 is forget them
+    # as soon as no row of the job needs them anymore), and the seconds after
+    # which all kept lookups are forgotten, so a long running service does
+    # not keep on using old data
+    self.lookup_memory = lookup_memory
+    self.lookup_max_age = lookup_max_age
+    self.lookups_cleared = time.monotonic()
+
+    # Amount of rows that are looked up at the same time (older config.py files
+    # don't have this setting, so fall back to one row at a time)
+    self.worker_count = max(1, self.setting('workers', 1))
+
+    # Amount of perceel reports that are asked to the GOB api at the same time
+    self.perceel_worker_count = max(1, self.setting('perceel_workers', self.worker_count))
+
+    # Amount of verblijfsobjecten pages of big panden that are fetched at the same time
+    self.page_worker_count = max(1, self.setting('page_workers', 4))
+
+    # Look addresses up per postcode instead of one by one
+    self.batch_postcodes = self.setting('batch_postcodes', False)
+
+    self.skip_perceel = self.setting('skip_perceel', False)
+
+    # Detail of every Nth row is logged (0 is none, failed rows are always
+    # logged), and a progress line every so many seconds (0 is none)
+    self.log_row_every = self.setting('log_row_every', 0)
+    self.progress_seconds = self.setting('progress_seconds', 10)
+
+    # Seconds a row may take (0 is no limit), rows that take longer are done
+    # again at the end of the job
+    self.row_deadline = self.setting('row_deadline', 300)
+
+    # Cache for api responses (off when no cache file is configured)
+    self.response_cache = None
+    if self.setting('cache_file', "") != "":
+      self.response_cache = ResponseCache(
+        config.cache_file,
+        ttl_days=self.setting('cache_ttl_days', {}),
+        max_mb=self.setting('cache_max_mb', 500)
+      )
+
+    # Rate limiter shared by both api's, with the maximum requests per second per host
+    self.rate_limiter = RateLimiter(self.setting('requests_per_second', {}))
+
+    # Shared clients for both api's, so connections are reused between rows.
+    # Or answer the BAG lookups from the local extract, with the same answers as the api.
+    if self.setting('offline_extract', "") != "":
+      self.bag_client = OfflineClient(BagExtract(config.offline_extract), config.api_base_url)
+    else:
+      self.bag_client = ApiClient(
+        "BAG API",
+        headers={
+        'X-Api-Key': config.api_key,
+        'Accept-Crs': 'epsg:28992'
+        },
+        pool_size=self.worker_count + self.page_worker_count,
+        retries=self.setting('retries', 3),
+        backoff=self.setting('retry_backoff', 0.5),
+        cache=self.response_cache,
+        rate_limiter=self.rate_limiter,
+        metrics=self.metrics,
+        timeouts=self.setting('timeouts', {}),
+        hedge_endpoints=self.setting('hedge_endpoints', []),
+        hedge_percentile=self.setting('hedge_percentile', 95)
+      )
+
+    self.gob_client = ApiClient(
+      "GOB API",
+      headers={
+      'X-Api-Key': self.setting('gob_api_key', "")
+      },
+      pool_size=self.perceel_worker_count,
+      retries=self.setting('retries', 3),
+      backoff=self.setting('retry_backoff', 0.5),
+      cache=self.response_cache,
+      rate_limiter=self.rate_limiter,
+      metrics=self.metrics,
+      timeouts=self.setting('timeouts', {}),
+      hedge_endpoints=self.setting('hedge_endpoints', []),
+      hedge_percentile=self.setting('hedge_percentile', 95)
+    )
+
+    # Worker threads, they are only started when there is work for them
+    self.executor = ThreadPoolExecutor(max_workers=self.worker_count)
+    self.perceel_executor = ThreadPoolExecutor(max_workers=self.perceel_worker_count)
+    self.page_executor = ThreadPoolExecutor(max_workers=self.page_worker_count)
+
+    # Verblijfsobjecten of panden, shared between rows that are in the same pand
+    self.pand_lookups = OrderedDict()
+
+    # Addresses of postcodes, shared between rows with the same postcode. Only the
+    # postcodes that were used last are kept.
+    self.postcode_lookups = OrderedDict()
+    self.postcode_lookups_max = 10000
+
+    # Perceel reports of nummeraanduidingen, waiting for their row to be processed
+    self.perceel_lookups = OrderedDict()
+
+    # All of these are used by all worker threads
+    self.lookups_lock = threading.Lock()
+
+    # Rows that were found in the addresses of their postcode, and the requests it took
+    self.postcode_batch_rows = 0
+    self.postcode_batch_requests = 0
+    self.postcode_batch_lock = threading.Lock()
+
+    # Input rows that were normalized, rows that only share the address of an
+    # earlier row because of that (each one request less), and the addresses
+    # that were searched again with their huisletter swapped (each one request
+    # more)
+    self.normalized_rows = 0
+    self.normalized_shared_rows = 0
+    self.swapped_searches = 0
+    self.shared_address_lock = threading.Lock()
+
+  def setting(self, name, default):
+
+    # Settings that are not in the config (older config.py files) get their default
+    return getattr(self.config, name, default)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+
+    self.executor.shutdown()
+    self.perceel_executor.shutdown()
+    self.page_executor.shutdown()
+    self.gob_client.close()
+    if isinstance(self.bag_client, ApiClient):
+      self.bag_client.close()
+    if self.response_cache is not None:
+      self.response_cache.close()
+
+  def job(self, write_row=None, row_count=None):
+
+    # Forget lookups that were kept for too long
+    with self.lookups_lock:
+      if time.monotonic() - self.lookups_cleared > self.lookup_max_age:
+        self.pand_lookups.clear()
+        self.perceel_lookups.clear()
+        self.postcode_lookups.clear()
+        self.lookups_cleared = time.monotonic()
+
+    return EnrichJob(self, write_row, row_count)
+
+  def enrich_job(self, rows):
+
+    # Do a whole job and keep its output rows in job.output_rows, with
+    # is_invoer as it is at the end of the job. Later rows can still change
+    # is_invoer of earlier ones, so the rows are only given when all are done.
+    # Until then they are kept per pand (see bagrows.py).
+    output_rows = RowStore()
+    job = self.job(row_count=len(rows) if hasattr(rows, '__len__') else None)
+    job.run(rows, on_outcome=lambda outcome: output_rows.add(outcome.get('rows', [])))
+
+    output_rows.invoer_patches = job.invoer_patches
+    job.output_rows = output_rows
+
+    return job
+
+  def enrich(self, rows):
+
+    return iter(self.enrich_job(rows).output_rows)
+
+  def forget_lookup(self, lookups, key, keep=False):
+
+    # A lookup no row of the job needs anymore. Kept for later jobs when
+    # lookups are remembered, the ones that were used last.
+    with self.lookups_lock:
+      if keep and self.lookup_memory > 0:
+        if key in lookups:
+          lookups.move_to_end(key)
+        while len(lookups) > self.lookup_memory:
+          lookups.popitem(last=False)
+      else:
+        lookups.pop(key, None)
+
+  def get_shared_lookup(self, lookups, key, lookup_function, *lookup_args):
+
+    # Rows that need the same data share one lookup, the first row to ask for
+    # it does the actual requests while the others just get the same future.
+    with self.lookups_lock:
+      shared_lookup = lookups.get(key)
+      is_new = shared_lookup is None
+      if is_new:
+        shared_lookup = Future()
+        lookups[key] = shared_lookup
+
+    if is_new:
+      try:
+        shared_lookup.set_result(lookup_function(*lookup_args))
+      except Exception as e:
+        shared_lookup.set_exception(e)
+
+    return shared_lookup
+
+  def get_pand(self, pand_href):
+
+    # Get pand of adres (according to https://lvbag.github.io/BAG-API/Technische%20specificatie/#/Pand/pandIdentificatie)
+    with self.metrics.phase('pand'):
+      pand_response = self.bag_client.get(pand_href, endpoint='panden')
+
+      # Parse json data
+      pand_data = pand_response.json()
+
+    # Check if the request went well
+    if pand_response.status_code != 200:
+      return {'error': pand_data.get('title', pand_response.status_code)}
+
+    # Get some data
+    pandId = pand_data['pand']['identificatie']
+    bouwjaar = pand_data['pand']['oorspronkelijkBouwjaar']
+
+    with self.metrics.phase('verblijfsobjecten'):
+      verblijfsobjecten_lookup = self.get_verblijfsobjecten(pandId)
+
+    if 'error' in verblijfsobjecten_lookup:
+      return verblijfsobjecten_lookup
+
+    # Only keep what goes into the output of every verblijfsobject, a pand
+    # lookup can be kept for a long time
+    units = []
+    for verblijfsobject in verblijfsobjecten_lookup['verblijfsobjecten']:
+      nummeraanduiding = verblijfsobject['_embedded']['heeftAlsHoofdAdres']['nummeraanduiding']
+      units.append(make_unit(
+        nummeraanduiding.get('postcode', ''),
+        nummeraanduiding.get('huisnummer', ''),
+        nummeraanduiding.get('huisletter', ''),
+        nummeraanduiding.get('huisnummertoevoeging', ''),
+        verblijfsobject['verblijfsobject'].get('identificatie', ''),
+        verblijfsobject['verblijfsobject'].get('oppervlakte', ''),
+        verblijfsobject['verblijfsobject'].get('gebruiksdoelen', [])[0],
+        verblijfsobject['verblijfsobject'].get('status', '')
+      ))
+
+    return {
+      'pandId': pandId,
+      'bouwjaar': bouwjaar,
+      'units': tuple(units),
+      'pages': verblijfsobjecten_lookup['pages'],
+      'prefetched_pages': verblijfsobjecten_lookup['prefetched_pages']
+    }
+
+  def get_verblijfsobjecten_page(self, pandId, page):
+
+    # Get a page of verblijfsobjecten of pand (according to https://lvbag.github.io/BAG-API/Technische%20specificatie/#/Verblijfsobject/zoekVerblijfsobjecten)
+    verblijfsobjecten_response = self.bag_client.get(
+      self.config.api_base_url + "verblijfsobjecten",
+      params={
+      'pandIdentificatie': pandId,
+      'expand': 'heeftAlsHoofdAdres',
+      'pageSize': 100, # Maximum of verblijfsobjecten per call
+      'page': page
+      },
+      endpoint='verblijfsobjecten'
+    )
+
+    # Parse the data
+    return verblijfsobjecten_response.status_code, verblijfsobjecten_response.json()
+
+  def get_verblijfsobjecten(self, pandId):
+
+    verblijfsobjecten = []
+    verblijfsobjecten_pages = 0
+    prefetched_pages = 0
+    page = 1
+
+    while page is not None:
+
+      verblijfsobjecten_status_code, verblijfsobjecten_data = self.get_verblijfsobjecten_page(pandId, page)
+
+      # Check if the request went well, a missing page would mean missing rows
+      if verblijfsobjecten_status_code != 200:
+        return {'error': verblijfsobjecten_data.get('title', verblijfsobjecten_status_code)}
+
+      # If no _embedded column, there were no objects on this 'page'
+      if verblijfsobjecten_data.get('_embedded', '') == "":
+        break
+
+      page_verblijfsobjecten = verblijfsobjecten_data['_embedded']['verblijfsobjecten']
+      verblijfsobjecten += page_verblijfsobjecten
+      verblijfsobjecten_pages = page
+
+      links = verblijfsobjecten_data.get('_links') or {}
+      last_page = get_link_page(links, 'last')
+
+      # The last page is known, so ask all pages after this one at the same
+      # time. The page workers put them back in order.
+      if last_page is not None and last_page > page:
+
+        page_lookups = [self.page_executor.submit(self.get_verblijfsobjecten_page, pandId, next_page) for next_page in range(page + 1, last_page + 1)]
+        for page_lookup in page_lookups:
+
+          verblijfsobjecten_status_code, verblijfsobjecten_data = page_lookup.result()
+          if verblijfsobjecten_status_code != 200:
+            return {'error': verblijfsobjecten_data.get('title', verblijfsobjecten_status_code)}
+
+          verblijfsobjecten += verblijfsobjecten_data.get('_embedded', {}).get('verblijfsobjecten', [])
+
+        verblijfsobjecten_pages = last_page
+        prefetched_pages = len(page_lookups)
+        break
+
+      # Follow the next link, no next link is the last page
+      if 'self' in links or 'next' in links or 'last' in links:
+        page = get_link_page(links, 'next')
+
+      # Without links, a full page could have more after it
+      elif len(page_verblijfsobjecten) == 100:
+        page += 1
+
+      else:
+        page = None
+
+    return {
+      'verblijfsobjecten': verblijfsobjecten,
+      'pages': verblijfsobjecten_pages,
+      'prefetched_pages': prefetched_pages
+    }
+
+  def get_postcode_addresses(self, postcode):
+
+    # Get all addresses with this postcode, 100 at a time
+    adressen = []
+    adressen_page = 0
+
+    while True:
+
+      adressen_page += 1
+
+      adres_response = self.bag_client.get(
+        self.config.api_base_url + "adressen",
+        params={
+        'postcode': postcode,
+        'pageSize': 100, # Maximum of addresses per call
+        'page': adressen_page
+        },
+        endpoint='adressen'
+      )
+
+      with self.postcode_batch_lock:
+        self.postcode_batch_requests += 1
+
+      # Parse the data
+      adres_data = adres_response.json()
+
+      # Check if the request went well
+      if adres_response.status_code != 200:
+        return {'status_code': adres_response.status_code, 'data': adres_data}
+
+      # No more addresses on this page
+      if adres_data.get('_embedded', '') == "":
+        break
+
+      adressen += adres_data['_embedded']['adressen']
+
+      # A page that is not full is the last one
+      if len(adres_data['_embedded']['adressen']) < 100:
+        break
+
+    return {'status_code': 200, 'adressen': adressen}
+
+  def find_in_postcode(self, params):
+
+    # Get (or wait for) the addresses of the postcode
+    postcode = params['postcode'].replace(' ', '').upper()
+    shared_lookup = self.get_shared_lookup(self.postcode_lookups, postcode, self.get_postcode_addresses, postcode)
+    postcode_lookup = shared_lookup.result()
+
+    # Forget the postcodes that were used the longest time ago. A postcode
+    # that could not be fetched is forgotten right away, the next row with
+    # that postcode tries again.
+    with self.lookups_lock:
+      if postcode_lookup['status_code'] != 200:
+        if self.postcode_lookups.get(postcode) is shared_lookup:
+          del self.postcode_lookups[postcode]
+      elif postcode in self.postcode_lookups:
+        self.postcode_lookups.move_to_end(postcode)
+      while len(self.postcode_lookups) > self.postcode_lookups_max:
+        self.postcode_lookups.popitem(last=False)
+
+    with self.postcode_batch_lock:
+      self.postcode_batch_rows += 1
+
+    if postcode_lookup['status_code'] != 200:
+      return postcode_lookup['status_code'], postcode_lookup['data']
+
+    # Same as exacteMatch: huisletter and huisnummertoevoeging have to be the
+    # same, and when they are not given the address should not have them either
+    for adres_object in postcode_lookup['adressen']:
+      if str(adres_object['huisnummer']) == params['huisnummer'].strip() \
+        and adres_object.get('huisletter', '').lower() == params.get('huisletter', '').strip().lower() \
+        and adres_object.get('huisnummertoevoeging', '').lower() == params.get('huisnummertoevoeging', '').strip().lower():
+
+        # Found, make it look like the answer of a normal search
+        return 200, {'_embedded': {'adressen': [adres_object]}}
+
+    # Not found, the normal search gives no _embedded column either
+    return 200, {}
+
+  def search_adres(self, params):
+
+    # Look the address up in all addresses of its postcode
+    if self.batch_postcodes and 'postcode' in params and params['huisnummer'].strip().isdigit():
+      return self.find_in_postcode(params)
+
+    # Search request for the adres (according to https://lvbag.github.io/BAG-API/Technische%20specificatie/#/Adres/bevraagAdressen)
+    adres_response = self.bag_client.get(
+      self.config.api_base_url + "adressen",
+      params=params,
+      endpoint='adressen'
+    )
+
+    # Parse the data. It's a JSON response, so use that
+    return adres_response.status_code, adres_response.json()
+
+  def get_perceel(self, nummeraanduiding, clock=None):
+
+    # When the worker thread started on the report (for the row deadline)
+    if clock is not None:
+      clock['started'] = time.monotonic()
+
+    # Init variables
+    perceel = {
+      'sectie': "",
+      'perceelnummer': "",
+      'perceeloppervlakte': "",
+      'perceelomschrijving': "",
+      'perceel_energielabel': "",
+      'message': None
+    }
+
+    # Body data to send with gob request
+    perceel_request_data = {
+      "bagId": nummeraanduiding,
+      "selection": [
+        {
+          "code": "buurtstatistieken",
+          "deliver": "partialProduct",
+          "purposeLimitations": []
+        }
+      ],
+      "includePdf": False
+    }
+
+    # Make request
+    with self.metrics.phase('perceel'):
+      perceel_response = self.gob_client.post(
+        self.config.gob_api_base_url + "report",
+        json = perceel_request_data,
+        endpoint = 'report'
+      )
+
+      # Parse data from json
+      perceel_data = perceel_response.json()
+
+    # Only good answers are used again by later jobs
+    perceel['status_code'] = perceel_response.status_code
+
+    if perceel_response.status_code != 200:
+      # Something went wrong
+      perceel['message'] = "- GOB API error on bagId \"{0}\": \"{1}\"".format(nummeraanduiding, perceel_data['message'])
+
+    else:
+
+      if 'general' in perceel_data['document']:
+
+        # Take data needed
+        perceelaanduiding = perceel_data['document']['general']['kadastraleAanduiding']['kadastraleAanduiding']
+        perceel['sectie'] = perceelaanduiding.split()[1]
+        perceel['perceelnummer'] = perceelaanduiding.split()[2]
+        perceel['perceeloppervlakte'] = float(perceel_data['document']['general']['size'])
+        perceel['perceelomschrijving'] = perceel_data['document']['general']['omschrijving']
+        perceel['perceel_energielabel'] = perceel_data['document']['general']['energieLabel']
+
+        # If no energielabel, make it empty instead of given text
+        if "geen energielabel" in perceel['perceel_energielabel']:
+          perceel['perceel_energielabel'] = ""
+
+      else:
+
+        perceel['message'] = "- Perceel data for bagId \"{0}\" was not given".format(nummeraanduiding)
+
+    return perceel
+
+  def get_perceel_lookup(self, nummeraanduiding):
+
+    # The GOB api is a lot slower than the BAG api, so perceel reports have
+    # their own worker threads. Rows with the same nummeraanduiding share one.
+    # A report has its own clock, the time it waits for one of those threads
+    # does not count for the deadline of its rows.
+    with self.lookups_lock:
+      perceel_lookup = self.perceel_lookups.get(nummeraanduiding)
+
+      # A report kept from an earlier job that went wrong is asked again
+      if perceel_lookup is not None and perceel_lookup.done() and (perceel_lookup.exception() is not None or perceel_lookup.result()['status_code'] != 200):
+        perceel_lookup = None
+
+      if perceel_lookup is None:
+        clock = {'started': None}
+        perceel_lookup = self.perceel_executor.submit(self.get_perceel, nummeraanduiding, clock)
+        perceel_lookup.clock = clock
+        self.perceel_lookups[nummeraanduiding] = perceel_lookup
+
+    return perceel_lookup
+
+  def summary(self):
+
+    # Lines for the end of a run
+    lines = []
+
+    # Log connection reuse
+    lines.append(self.bag_client.summary())
+    if not self.skip_perceel:
+      lines.append(self.gob_client.summary())
+
+    # Log requests saved by looking addresses up per postcode
+    if self.batch_postcodes:
+      lines.append("Postcode batching: {0} addresses found with {1} requests, saved {2} requests".format(self.postcode_batch_rows, self.postcode_batch_requests, self.postcode_batch_rows - self.postcode_batch_requests))
+
+    # Log requests saved by looking every address up once
+    if self.normalized_rows > 0 or self.swapped_searches > 0:
+      lines.append("Input: {0} rows normalized, {1} of them had the address of an earlier row written differently, {2} addresses searched again with the huisletter swapped, saved {3} requests".format(self.normalized_rows, self.normalized_shared_rows, self.swapped_searches, self.normalized_shared_rows - self.swapped_searches))
+
+    # Log the request rates the rate limiter settled on
+    lines += self.rate_limiter.summary()
+
+    # Log cache use
+    if self.response_cache is not None:
+      lines.append(self.response_cache.summary())
+
+    return lines
+
+# ==================================================================================
+#                                       JOB
+# ==================================================================================
+
+class EnrichJob:
+
+  def __init__(self, enricher, write_row=None, row_count=None):
+
+    self.enricher = enricher
+    self.write_row = write_row
+    self.row_count = row_count
+
+    # Declare output
+    self.output_row_count = 0
+    self.output_failures = []
+    self.output_skips = []
+
+    # Output rows are given to write_row as soon as their input row is done,
+    # so they are not kept in memory. These indexes remember the number of the
+    # first output row with an address or pand, to find earlier rows quickly.
+    #
+    # Any later row at one of the panden in pand_index will be skipped, so the
+    # worker threads also use it to know there is no need to fetch anything.
+    self.address_index = {}
+    self.pand_index = {}
+
+    # Later rows can turn is_invoer on for rows that are already written. Those
+    # output row numbers are collected here, and fixed when the job is done.
+    self.invoer_patches = set()
+
+    # Rows that took longer than their deadline, to try again at the end
+    self.retry_rows = []
+
+    # Address lookups by address key, rows with the same address share one.
+    # A lookup is kept until the address is in the output (or failed with an
+    # error, the next row tries again). Addresses that were not found are
+    # kept, without the lookups of their pand and perceel.
+    self.address_lookups = {}
+
+    # The ways the addresses of the rows were written before normalization,
+    # by address key. Without normalization each one is a lookup of its own.
+    self.address_spellings = {}
+
+    # Log lines of the row being processed, and when to log the progress
+    self.row_messages = []
+    self.progress_started = time.monotonic()
+    self.progress_start_row = 0
+    self.progress_next = self.progress_started + enricher.progress_seconds
+
+  def add_output_row(self, output_row):
+
+    if self.write_row is not None:
+      self.write_row(output_row)
+
+    # Only the first row counts, just like when searching from the start
+    self.address_index.setdefault(get_address_key(output_row), self.output_row_count)
+    self.pand_index.setdefault(output_row['pandId'], self.output_row_count)
+
+    self.output_row_count += 1
+
+  def find_processed_address(self, row):
+
+    # Check if adress has already been processed based on postcode + huisnummer
+    return self.address_index.get(get_address_key(row))
+
+  def get_address_lookup(self, row):
+
+    # The lookup of the address of the row, done by a worker thread, and its
+    # clock: when the worker thread started it (for the row deadline)
+    enricher = self.enricher
+    key = get_address_key(row)
+
+    address_lookup = self.address_lookups.get(key)
+    if address_lookup is not None:
+      return address_lookup
+
+    clock = {'started': None}
+    address_lookup = (enricher.executor.submit(self.lookup_row, row, clock), clock)
+    self.address_lookups[key] = address_lookup
+    return address_lookup
+
+  def count_spelling(self, given_row, row, changed):
+
+    # Remember how the address of the row was written in the input
+    enricher = self.enricher
+    key = get_address_key(row)
+    given_key = key
+    if changed:
+      given_key = get_address_key({name: "" if given_row.get(name) is None else str(given_row[name]) for name in INPUT_COLUMNS})
+
+    spellings = self.address_spellings.setdefault(key, set())
+    if len(spellings) > 0 and given_key not in spellings:
+      with enricher.shared_address_lock:
+        enricher.normalized_shared_rows += 1
+    spellings.add(given_key)
+
+  def find_processed_pand(self, pandId):
+
+    # Check if pand has already been processed based on pandId
+    return self.pand_index.get(pandId)
+
+  def lookup_row(self, row, clock):
+
+    enricher = self.enricher
+    clock['started'] = time.monotonic()
+
+    # ==================================================================================
+    #                                    SEARCH FOR ADRES
+    # ==================================================================================
+
+    # Add all the parameters based on conditions
+    params = {}
+
+    if row.get('postcode', '') != "":
+
+      # Postcode is given
+      params['postcode'] = row['postcode']
+      params['huisnummer'] = row['huisnummer']
+      params['exacteMatch'] = 'true'
+
+      query = '{0} {1}'.format(row['postcode'], row['huisnummer'])
+
+      # Optionally add huisnummertoevoeging
+      if row.get('huisletter', "") != "":
+        params['huisletter'] = row['huisletter']
+      if row.get('huisnummertoevoeging', "") != "":
+        params['huisnummertoevoeging'] = row['huisnummertoevoeging']
+
+    else:
+
+      # Postcode is not given, search based on query
+      query = '{0} {1}{2}, {3}'.format(row['straat'], row['huisnummer'], row['huisnummertoevoeging'], row['stad'])
+      params['q'] = query
+
+    lookup = {'query': query}
+
+    # Search for the adres
+    with enricher.metrics.phase('address'):
+      adres_status_code, adres_data = enricher.search_adres(params)
+
+      # A huisletter is often written as huisnummertoevoeging (or the other
+      # way around), when the address is not found try it the other way
+      swapped_params = swap_huisletter(params) if 'postcode' in params else None
+      if adres_status_code == 200 and adres_data.get('_embedded', '') == "" and swapped_params is not None:
+        adres_status_code, adres_data = enricher.search_adres(swapped_params)
+        with enricher.shared_address_lock:
+          enricher.swapped_searches += 1
+
+    # Check if the request went well
+    if adres_status_code != 200:
+
+      # Something went wrong
+      lookup['error'] = adres_data['title']
+      return lookup
+
+    # _embedded column won't be there if no results are given
+    if adres_data.get('_embedded', '') == "":
+      lookup['not_found'] = True
+      return lookup
+
+    # Get some data
+    adres_object = adres_data['_embedded']['adressen'][0]
+    lookup['adres'] = {
+      'korteNaam': adres_object['korteNaam'],
+      'huisnummer': adres_object['huisnummer'],
+      'woonplaats': adres_object['woonplaatsNaam'],
+      'huisletter': adres_object.get('huisletter', ''),
+      'huisnummertoevoeging': adres_object.get('huisnummertoevoeging', ''),
+      'postcode': adres_object['postcode'],
+      'pandId': adres_object['pandIdentificaties'][0],
+      'nummeraanduiding': adres_object['nummeraanduidingIdentificatie']
+    }
+
+    # Nothing more to fetch if this row is going to be skipped anyway
+    pandId = lookup['adres']['pandId']
+    if pandId in self.pand_index:
+      return lookup
+
+    # ==================================================================================
+    #                                   GET PERCEEL
+    # ==================================================================================
+
+    # Optionally skip. The report is only asked for here, it is done by the
+    # perceel worker threads while this row continues with the pand.
+    if not enricher.skip_perceel:
+      lookup['perceel'] = enricher.get_perceel_lookup(lookup['adres']['nummeraanduiding'])
+
+    # ==================================================================================
+    #                           GET PAND AND VERBLIJFSOBJECTEN
+    # ==================================================================================
+
+    lookup['pand'] = enricher.get_shared_lookup(enricher.pand_lookups, pandId, enricher.get_pand, adres_object['_links']['panden'][0]['href'])
+
+    return lookup
+
+  # ==================================================================================
+  #                                 PROCESS FUNCTION
+  # ==================================================================================
+
+  def log_row(self, message, *args):
+
+    # Detail of the row being processed, it is written to the log when the
+    # row is done (and is one of the rows that are logged). Most rows are
+    # not, so the message is only filled in with its args then.
+    self.row_messages.append((message, args))
+
+  def wait_for(self, future, clock):
+
+    # Result of a lookup of the row. With a row deadline, the row waits until
+    # that many seconds after the worker thread started on its address. The
+    # time it waited for a worker thread does not count, that is the fault
+    # of the rows before it.
+    row_deadline = self.enricher.row_deadline
+    if clock is None or row_deadline <= 0:
+      return future.result()
+
+    while True:
+      started = clock['started']
+      timeout = row_deadline if started is None else max(0, started + row_deadline - time.monotonic())
+      try:
+        return future.result(timeout=timeout)
+      except TimeoutError:
+        if started is not None:
+          raise
+
+  def process_row(self, row_index, row, lookup_future, clock=None):
+
+    # What happened to this row, for the journal
+    outcome = {'row': row_index, 'key': get_address_key(row)}
+
+    # Check if adress has already been processed based on postcode + huisnummer
+    output_row_number = self.find_processed_address(row)
+    if output_row_number is not None:
+      self.log_row("- Address already processed. Skipping row.")
+
+      # Stop here, and continue with next row
+      outcome.update({'outcome': 'skip', 'reason': 'address', 'invoer': output_row_number})
+      return outcome
+
+    # Wait for the worker thread to finish this row
+    lookup = self.wait_for(lookup_future, clock)
+
+    # Only this row was waiting for its perceel report (it holds on to it
+    # itself), unless it is kept for later jobs
+    if 'perceel' in lookup:
+      self.enricher.forget_lookup(self.enricher.perceel_lookups, lookup['adres']['nummeraanduiding'], keep=True)
+
+    # Check if the request went well
+    if 'error' in lookup:
+
+      # Something went wrong
+      self.log_row('- Error: {0}', lookup['error'])
+
+      # Stop here, and continue with the next row
+      outcome.update({'outcome': 'failure', 'reason': 'error'})
+      return outcome
+
+    # Check data
+    if lookup.get('not_found', False):
+      self.log_row("- Error: address {0} was not found.", lookup['query'])
+
+      # Stop here, contiue on new row
+      outcome.update({'outcome': 'failure', 'reason': 'not_found'})
+      return outcome
+
+    # Get some data
+    adres = lookup['adres']
+    korteNaam = adres['korteNaam']
+    huisnummer = adres['huisnummer']
+    woonplaats = adres['woonplaats']
+    huisletter = adres['huisletter']
+    huisnummertoevoeging = adres['huisnummertoevoeging']
+    postcode = adres['postcode']
+    pandId = adres['pandId']
+
+    # Mechanism to check if search query found the right result
+    full_huisnummer = str(huisnummer) + huisletter.lower() + huisnummertoevoeging.lower()
+    full_huisnummer_row = row['huisnummer'] + row.get('huisletter', '').lower() + row.get('huisnummertoevoeging', '').lower()
+
+    # Check if pand has already been processed based on pandId
+    outcome['pandId'] = pandId
+    output_row_number = self.find_processed_pand(pandId)
+    if output_row_number is not None:
+      self.log_row("- Pand already processed. Skipping row.")
+
+      # Stop here, and continue with next row
+      outcome.update({'outcome': 'skip', 'reason': 'pand', 'invoer': output_row_number})
+      return outcome
+
+    if full_huisnummer != full_huisnummer_row: # Is mismatch
+      self.log_row("- Error: address was not found and so another address was returned by the API instead (expected huisnummer {0}, got {1}).", full_huisnummer_row, full_huisnummer)
+
+      # Stop here, and continue with next row
+      outcome.update({'outcome': 'failure', 'reason': 'mismatch'})
+      return outcome
+
+    # Log info
+    self.log_row("- Address is: {0} {1}{2}{3}, {4} {5}", korteNaam, huisnummer, huisletter, huisnummertoevoeging, postcode, woonplaats)
+
+    # Wait for pand and verblijfsobjecten
+    pand = self.wait_for(lookup['pand'], clock)
+
+    # Check if the requests went well
+    if 'error' in pand:
+      self.log_row('- Error: {0}', pand['error'])
+
+      # Stop here, and continue with the next row
+      outcome.update({'outcome': 'failure', 'reason': 'error'})
+      return outcome
+    pandId = pand['pandId']
+    bouwjaar = pand['bouwjaar']
+    units = pand['units']
+
+    self.log_row("- Found pand: {0}", pandId)
+
+    # Wait for the perceel data, empty when skipped
+    perceel = {}
+    if 'perceel' in lookup:
+      perceel = self.wait_for(lookup['perceel'], lookup['perceel'].clock if clock is not None else None)
+    if perceel.get('message') is not None:
+      self.log_row(perceel['message'])
+
+    # Data to be extracted:
+    #
+    # - Postcode
+    # - PandID
+    # - Bouwjaar
+    #
+    # For every verblijfsobject:
+    #
+    # - Verblijfsobject ID
+    # - Huisnummer
+    # - Oppervlakte
+    # - Gebruiksdoel
+    # - Status
+
+    # The pand columns are the same for every row, see bagrows.py
+    pand_values = make_pand(
+      korteNaam,
+      woonplaats,
+      pandId,
+      bouwjaar,
+      perceel.get('sectie', ""),
+      perceel.get('perceelnummer', ""),
+      perceel.get('perceeloppervlakte', ""),
+      perceel.get('perceelomschrijving', ""),
+      perceel.get('perceel_energielabel', "")
+    )
+    rows = PandRows(pand_values, (), b'')
+
+    if len(units) == 1: # Pand contains only a single verblijfsobject
+
+      # With the address that was searched for
+      unit = units[0]
+      rows = PandRows(pand_values, (make_unit(postcode, huisnummer, huisletter, huisnummertoevoeging, *unit[4:]),), b'\x01')
+
+    if len(units) > 1: # Pand contains multiple verblijfsobjecten
+
+      # Add column that indicates that a row was the original address
+      invoer = bytes(str(unit[1]) + unit[3].lower() == full_huisnummer for unit in units)
+      rows = PandRows(pand_values, units, invoer)
+
+    outcome.update({'outcome': 'rows', 'pandId': pandId, 'rows': rows})
+
+    if pand['prefetched_pages'] > 0:
+      self.log_row("- Found {0} verblijfsobjecten at pand (spread over {1} pages, {2} of them fetched at the same time)", len(units), pand['pages'], pand['prefetched_pages'])
+    else:
+      self.log_row("- Found {0} verblijfsobjecten at pand (spread over {1} pages)", len(units), pand['pages'])
+
+    return outcome
+
+  def reuse_outcome(self, outcome, row):
+
+    # Outcome of a row from the outcome it got in another run (or shard),
+    # where other rows came before it. The duplicate checks are done again,
+    # in the same order as process_row does them. A skip there needs the
+    # pandId of the row it was a duplicate of.
+    #
+    # None when the row has to be looked up again: a skip there that is the
+    # first row at its pand here. The rows of that pand have the perceel (and
+    # for a pand with one verblijfsobject, the address) of another row.
+    reused = {'row': outcome['row'], 'key': outcome['key']}
+    pandId = outcome.get('pandId')
+    if pandId is not None:
+      reused['pandId'] = pandId
+
+    output_row_number = self.address_index.get(outcome['key'])
+    reason = 'address'
+    if output_row_number is None and pandId is not None:
+      output_row_number = self.find_processed_pand(pandId)
+      reason = 'pand'
+
+    if output_row_number is not None:
+      reused.update({'outcome': 'skip', 'reason': reason, 'invoer': output_row_number})
+    elif outcome['outcome'] == 'failure':
+      reused.update({'outcome': 'failure', 'reason': outcome['reason']})
+    elif outcome['outcome'] == 'rows':
+      reused.update({'outcome': 'rows', 'rows': outcome['rows']})
+    else:
+      return None
+
+    return reused
+
+  def look_up_again(self, row_index, row):
+
+    # A row whose outcome in another run (or shard) can't be reused
+    self.row_messages = []
+    return self.process_row(row_index, row, *self.get_address_lookup(row))
+
+  def apply_outcome(self, outcome):
+
+    # Do the bookkeeping for a processed row (or one replayed from the journal)
+    if outcome['outcome'] == 'skip':
+      self.invoer_patches.add(outcome['invoer'])
+      self.output_skips.append(outcome['row'])
+
+    elif outcome['outcome'] == 'retry':
+
+      # Done again later, its real outcome follows then
+      return
+
+    elif outcome['outcome'] == 'failure':
+      self.output_failures.append(outcome['row'])
+
+      # A pand that could not be fetched is tried again by the next row
+      if outcome['reason'] == 'error' and 'pandId' in outcome:
+        self.enricher.forget_lookup(self.enricher.pand_lookups, outcome['pandId'])
+
+    else:
+      for output_row in outcome['rows']:
+        self.add_output_row(output_row)
+
+      # Later rows at this pand will be skipped, so the shared lookup can go
+      # (or is kept for later jobs)
+      if outcome['pandId'] in self.pand_index:
+        self.enricher.forget_lookup(self.enricher.pand_lookups, outcome['pandId'], keep=True)
+
+    # Later rows with this address skip it or fail the same way, without a new lookup
+    address_lookup = self.address_lookups.pop(outcome['key'], None)
+    if address_lookup is not None and outcome['outcome'] == 'failure' and outcome['reason'] in ('not_found', 'mismatch'):
+      lookup = address_lookup[0].result()
+      kept_lookup = Future()
+      kept_lookup.set_result({name: lookup[name] for name in ('query', 'not_found', 'adres') if name in lookup})
+      self.address_lookups[outcome['key']] = (kept_lookup, address_lookup[1])
+
+  def reuse_row(self, row_index, row, previous_outcome):
+
+    outcome = self.reuse_outcome(dict(previous_outcome, row=row_index), row)
+    if outcome is None:
+      return self.look_up_again(row_index, row)
+
+    if outcome['outcome'] == 'skip':
+      self.log_row("- {0} already processed. Skipping row.", 'Address' if outcome['reason'] == 'address' else 'Pand')
+    elif outcome['outcome'] == 'failure':
+      self.log_row("- Error: {0} in the previous run.", outcome['reason'].replace('_', ' '))
+    else:
+      self.log_row("- Taken from the previous run: pand {0} with {1} verblijfsobjecten", outcome['pandId'], len(outcome['rows']))
+
+    return outcome
+
+  def write_row_log(self, row_index, outcome):
+
+    # Only some rows are logged, writing every line of every row costs more
+    # than processing them when the answers come from the cache
+    log_row_every = self.enricher.log_row_every
+    if (log_row_every > 0 and row_index % log_row_every == 0) or outcome['outcome'] in ('failure', 'retry'):
+
+      if self.row_count is not None:
+        log.info('Processing row {0}/{1} ({2}%)'.format(row_index+1, self.row_count, round(row_index/self.row_count*100)))
+      else:
+        log.info('Processing row {0}'.format(row_index+1))
+
+      for message, args in self.row_messages:
+        log.info(message.format(*args) if len(args) > 0 else message)
+
+  def log_progress(self, row_index):
+
+    progress_seconds = self.enricher.progress_seconds
+    now = time.monotonic()
+    if progress_seconds <= 0 or now < self.progress_next:
+      return
+    self.progress_next = now + progress_seconds
+
+    # Rows per second since the job started (or was resumed)
+    rows_per_second = (row_index + 1 - self.progress_start_row) / max(now - self.progress_started, 0.001)
+    counts = "{0} failed & {1} skipped".format(len(self.output_failures), len(self.output_skips))
+
+    if self.row_count is not None:
+      rows_left = self.row_count - row_index - 1
+      log.info("Progress: row {0}/{1} ({2}%), {3:.1f} rows/s, about {4} left, {5}".format(row_index+1, self.row_count, round((row_index+1)/self.row_count*100), rows_per_second, format_duration(rows_left / rows_per_second), counts))
+    else:
+      log.info("Progress: row {0}, {1:.1f} rows/s, {2}".format(row_index+1, rows_per_second, counts))
+
+  def defer_row(self, row_index, row, retrying):
+
+    # The row took longer than its deadline. Its requests are left to finish
+    # by themselves, the row is tried again at the end (once). The lookups it
+    # was waiting for are dropped, so that try sends new requests.
+    outcome = {'row': row_index, 'key': get_address_key(row)}
+    self.drop_lookups(outcome['key'])
+
+    if retrying:
+      self.log_row("- Error: took longer than {0}s, also when trying again.", self.enricher.row_deadline)
+      outcome.update({'outcome': 'failure', 'reason': 'deadline'})
+    else:
+      self.log_row("- Took longer than {0}s, trying again at the end.", self.enricher.row_deadline)
+      outcome['outcome'] = 'retry'
+      self.retry_rows.append((row_index, row))
+
+    return outcome
+
+  def drop_lookups(self, key):
+
+    # The address lookup, and the pand and perceel lookups that are not done yet
+    enricher = self.enricher
+    address_lookup = self.address_lookups.pop(key, None)
+    if address_lookup is None or not address_lookup[0].done():
+      return
+
+    lookup = address_lookup[0].result()
+    if 'pand' in lookup and not lookup['pand'].done():
+      enricher.forget_lookup(enricher.pand_lookups, lookup['adres']['pandId'])
+    if 'perceel' in lookup and not lookup['perceel'].done():
+      enricher.forget_lookup(enricher.perceel_lookups, lookup['adres']['nummeraanduiding'])
+
+  def finish_row(self, row_index, row, lookup_future, clock, previous_outcome, on_outcome, retrying=False):
+
+    # Processing includes waiting for the lookup, its cpu time does not
+    self.row_messages = []
+    with self.enricher.metrics.phase('process'):
+      try:
+        if previous_outcome is not None:
+          outcome = self.reuse_row(row_index, row, previous_outcome)
+        else:
+          outcome = self.process_row(row_index, row, lookup_future, clock)
+      except TimeoutError:
+        outcome = self.defer_row(row_index, row, retrying)
+
+    with self.enricher.metrics.phase('output'):
+      self.apply_outcome(outcome)
+      if on_outcome is not None:
+        on_outcome(outcome)
+
+      self.write_row_log(row_index, outcome)
+      self.log_progress(row_index)
+
+  # ==================================================================================
+  #                                    MAIN LOOP
+  # ==================================================================================
+
+  def run(self, rows, start=0, on_outcome=None, row_filter=None, previous_run=None, retry_rows=()):
+
+    # Rows before start were done before (for example replayed from a journal).
+    # on_outcome is called with the outcome of every row, in order. With a
+    # row_filter only the rows it gives True for are done (the rows of a shard).
+    # Rows a previous_run (see bagdelta.py) has an outcome for are not looked
+    # up again. retry_rows are the numbers of rows before start that still
+    # have to be tried again.
+    enricher = self.enricher
+    self.progress_started = time.monotonic()
+    self.progress_start_row = start
+    self.progress_next = self.progress_started + enricher.progress_seconds
+
+    def rows_to_do():
+
+      # Loop through each row
+      for row_index, row in enumerate(rows):
+
+        # Rows that were done before the run was interrupted
+        if row_index < start:
+          if row_index in retry_rows:
+            self.retry_rows.append((row_index, normalize_row(row)[0]))
+          continue
+        if row_filter is not None and not row_filter(row):
+          continue
+
+        # The same address is always written the same way, see bagnormalize.py
+        given_row = row
+        row, changed = normalize_row(row)
+        if changed:
+          with enricher.shared_address_lock:
+            enricher.normalized_rows += 1
+
+        previous_outcome = None
+        if previous_run is not None:
+          previous_outcome = previous_run.get(row)
+
+        # A normalized row saved a request when its address was written
+        # differently before, by an earlier row that is looked up
+        if previous_outcome is None:
+          self.count_spelling(given_row, row, changed)
+
+        yield row_index, row, previous_outcome
+
+    self.process_rows(rows_to_do(), on_outcome)
+    self.retry_deferred_rows(on_outcome)
+
+  def retry_deferred_rows(self, on_outcome):
+
+    # Rows that took longer than the deadline get one more try, now that all
+    # other rows are done
+    if len(self.retry_rows) > 0:
+      log.info("Trying {0} rows again that took longer than {1}s".format(len(self.retry_rows), self.enricher.row_deadline))
+
+      retry_rows, self.retry_rows = self.retry_rows, []
+      self.process_rows(((row_index, row, None) for row_index, row in retry_rows), on_outcome, retrying=True)
+
+  def process_rows(self, rows, on_outcome, retrying=False):
+
+    enricher = self.enricher
+
+    # Rows that are being looked up right now, oldest first. Enough rows are kept
+    # in flight to keep both the BAG and the perceel worker threads busy.
+    in_flight = deque()
+    in_flight_max = (enricher.worker_count + enricher.perceel_worker_count) * 4
+
+    for row_index, row, previous_outcome in rows:
+
+      # Rows at an address that is already in the output will be skipped,
+      # so don't bother the API with them
+      lookup_future, clock = None, None
+      if previous_outcome is None and self.find_processed_address(row) is None:
+        lookup_future, clock = self.get_address_lookup(row)
+
+      in_flight.append((row_index, row, lookup_future, clock, previous_outcome))
+
+      # Keep a limited amount of rows ahead, process the oldest one
+      if len(in_flight) >= in_flight_max:
+        self.finish_row(*in_flight.popleft(), on_outcome, retrying)
+
+    # Process the rows that are left
+    while len(in_flight) > 0:
+      self.finish_row(*in_flight.popleft(), on_outcome, retrying)
+
+def enrich(rows, config=None):
+
+  # Output rows of the input rows, with a fresh Enricher. To do many jobs,
+  # keep an Enricher and use its enrich() instead.
+  if config is None:
+    import config
+
+  with Enricher(config) as enricher:
+    for output_row in enricher.enrich(rows):
+      yield output_row
@@ -0,0 +1,109 @@
+# ==================================================================================
+#                                    RUN JOURNAL
+# ==================================================================================
+
+# While running, the outcome of every input row is written to a journal: the
+# output rows it gave, or the reason it failed or was skipped. When a run gets
+# interrupted (network down, expired key, Ctrl-C), it can be resumed with
+# --resume. The rows in the journal are then replayed instead of asked to the
+# api again.
+#
+# The journal is a text file with one JSON object per line. The first line
+# describes the input, so a journal is never resumed with another input.csv.
+
+import json
+import os
+from hashlib import sha1
+
+# Increase when the format of the journal changes
+JOURNAL_VERSION = 2
+
+def fingerprint_file(filename):
+
+  # Hash of the file content, read in pieces so big files are no problem
+  file_hash = sha1()
+  with open(filename, 'rb') as file:
+    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+      file_hash.update(chunk)
+
+  return file_hash.hexdigest()
+
+class RunJournal:
+
+  def __init__(self, filename, sync_every=100):
+
+    self.filename = filename
+    self.sync_every = sync_every
+    self.file = None
+    self.unsynced = 0
+
+    # Length of the part of the file that could be read back
+    self.valid_size = 0
+
+  def read_header(self):
+
+    if not os.path.exists(self.filename):
+      return None
+
+    with open(self.filename, 'rb') as file:
+      try:
+        return json.loads(file.readline())
+      except ValueError:
+        return None
+
+  def replay(self):
+
+    # Give back the outcomes in the journal, in order. The last line can be
+    # half written when the run was killed, everything from there is ignored.
+    with open(self.filename, 'rb') as file:
+
+      self.valid_size = len(file.readline())
+
+      for line in file:
+        if not line.endswith(b'\n'):
+          break
+        try:
+          outcome = json.loads(line)
+        except ValueError:
+          break
+
+        self.valid_size += len(line)
+        yield outcome
+
+  def open(self, header, append=False):
+
+    if append:
+
+      # Cut off whatever could not be read back, and continue after it
+      with open(self.filename, 'r+b') as file:
+        file.truncate(self.valid_size)
+      self.file = open(self.filename, 'a', encoding='utf-8')
+
+    else:
+
+      self.file = open(self.filename, 'w', encoding='utf-8')
+      self.file.write(json.dumps(header) + '\n')
+      self.sync()
+
+  def write(self, outcome):
+
+    # Rows kept per pand (see bagrows.py) are written as a list of rows
+    self.file.write(json.dumps(outcome, default=list) + '\n')
+
+    # Flushing makes sure a crash of the program loses nothing, syncing
+    # (which is slow) protects against a crash of the whole machine
+    self.file.flush()
+    self.unsynced += 1
+    if self.unsynced >= self.sync_every:
+      self.sync()
+
+  def sync(self):
+
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.unsynced = 0
+
+  def close(self):
+
+    self.sync()
+    self.file.close()
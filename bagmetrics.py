@@ -0,0 +1,239 @@
+# ==================================================================================
+#                                   RUN METRICS
+# ==================================================================================
+
+# Measurements of a run, to see where the time goes: every request to the api's
+# (latency, status code, bytes, retries) and every phase of a row (address
+# search, pand, verblijfsobjecten, perceel, processing and output).
+#
+# Latencies are kept in histograms with fixed buckets, like Prometheus does, so
+# the memory used stays the same however long the run is.
+#
+# At the end of the run the measurements are written as a JSON report and as a
+# Prometheus textfile (for the textfile collector of node_exporter).
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+class Histogram:
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+
+    self.buckets = buckets
+
+    # One more for everything above the last bucket
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+
+    index = 0
+    while index < len(self.buckets) and value > self.buckets[index]:
+      index += 1
+
+    self.counts[index] += 1
+    self.count += 1
+    self.sum += value
+
+  def percentile(self, percent):
+
+    # Upper bound of the bucket the percentile falls in, so it is an estimate
+    if self.count == 0:
+      return 0.0
+
+    rank = self.count * percent / 100
+    seen = 0
+    for index, count in enumerate(self.counts[:-1]):
+      seen += count
+      if seen >= rank:
+        return self.buckets[index]
+
+    return float('inf')
+
+  def cumulative_counts(self):
+
+    # Prometheus buckets count everything up to their bound
+    counts = []
+    seen = 0
+    for count in self.counts:
+      seen += count
+      counts.append(seen)
+
+    return counts
+
+  def report(self):
+
+    return {
+      'count': self.count,
+      'seconds': self.sum,
+      'p50': self.percentile(50),
+      'p95': self.percentile(95),
+      'p99': self.percentile(99)
+    }
+
+class RequestMetrics:
+
+  def __init__(self):
+
+    self.latency = Histogram()
+    self.status_codes = {}
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.retries = 0
+    self.cached = 0
+
+  def report(self):
+
+    report = self.latency.report()
+    report.update({
+      'status_codes': {str(status_code): count for status_code, count in sorted(self.status_codes.items())},
+      'bytes_sent': self.bytes_sent,
+      'bytes_received': self.bytes_received,
+      'retries': self.retries,
+      'cached': self.cached
+    })
+
+    return report
+
+class PhaseMetrics:
+
+  def __init__(self):
+
+    self.latency = Histogram()
+
+    # Time the thread actually used the cpu, the rest was waiting
+    self.cpu_seconds = 0.0
+
+  def report(self):
+
+    report = self.latency.report()
+    report['cpu_seconds'] = self.cpu_seconds
+
+    return report
+
+class RunMetrics:
+
+  def __init__(self):
+
+    self.started = time.time()
+    self.started_clock = time.perf_counter()
+    self.requests = {}
+    self.phases = {}
+    self.lock = threading.Lock()
+
+  def observe_request(self, api, endpoint, status_code, seconds, bytes_sent, bytes_received, retries):
+
+    with self.lock:
+      metrics = self.requests.setdefault((api, endpoint or 'other'), RequestMetrics())
+      metrics.latency.observe(seconds)
+      metrics.status_codes[status_code] = metrics.status_codes.get(status_code, 0) + 1
+      metrics.bytes_sent += bytes_sent
+      metrics.bytes_received += bytes_received
+      metrics.retries += retries
+
+  def observe_cached(self, api, endpoint):
+
+    with self.lock:
+      self.requests.setdefault((api, endpoint or 'other'), RequestMetrics()).cached += 1
+
+  def observe_phase(self, phase, seconds, cpu_seconds):
+
+    with self.lock:
+      metrics = self.phases.setdefault(phase, PhaseMetrics())
+      metrics.latency.observe(seconds)
+      metrics.cpu_seconds += cpu_seconds
+
+  @contextmanager
+  def phase(self, phase):
+
+    # Time a phase, also when it ends with an exception or return
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+      yield
+    finally:
+      self.observe_phase(phase, time.perf_counter() - started, time.thread_time() - cpu_started)
+
+  def report(self, rows):
+
+    # rows has the row counts of the run: input, output, failed and skipped
+    duration = time.perf_counter() - self.started_clock
+
+    with self.lock:
+      return {
+        'started': self.started,
+        'seconds': duration,
+        'rows': rows,
+        'rows_per_second': rows['input'] / duration if duration > 0 else 0.0,
+        'requests': [dict(api=api, endpoint=endpoint, **metrics.report()) for (api, endpoint), metrics in sorted(self.requests.items())],
+        'phases': {phase: metrics.report() for phase, metrics in sorted(self.phases.items())}
+      }
+
+  def write_json(self, filename, report):
+
+    with open(filename, 'w', encoding='utf-8') as json_file:
+      json.dump(report, json_file, indent=2)
+
+  def write_prometheus(self, filename, report):
+
+    # The collector could read the file while it is written, so write it
+    # next to it and move it in place
+    with open(filename + '.tmp', 'w', encoding='utf-8') as prometheus_file:
+      prometheus_file.write(self.format_prometheus(report))
+    os.replace(filename + '.tmp', filename)
+
+  def format_prometheus(self, report):
+
+    lines = []
+
+    def add(name, kind, help_text, samples):
+      lines.append("# HELP {0} {1}".format(name, help_text))
+      lines.append("# TYPE {0} {1}".format(name, kind))
+      for labels, value in samples:
+        lines.append("{0}{1} {2}".format(name, format_labels(labels), repr(float(value))))
+
+    def add_histogram(name, help_text, histograms):
+      lines.append("# HELP {0} {1}".format(name, help_text))
+      lines.append("# TYPE {0} histogram".format(name))
+      for labels, histogram in histograms:
+        bounds = [repr(bound) for bound in histogram.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, histogram.cumulative_counts()):
+          lines.append("{0}_bucket{1} {2}".format(name, format_labels(dict(labels, le=bound)), count))
+        lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), repr(histogram.sum)))
+        lines.append("{0}_count{1} {2}".format(name, format_labels(labels), histogram.count))
+
+    with self.lock:
+      requests = sorted(self.requests.items())
+      phases = sorted(self.phases.items())
+
+      add("bagapi_run_start_timestamp_seconds", "gauge", "Time the run started.", [({}, report['started'])])
+      add("bagapi_run_duration_seconds", "gauge", "Duration of the run.", [({}, report['seconds'])])
+      add("bagapi_rows", "gauge", "Rows of the run, by kind.", [({'kind': kind}, count) for kind, count in sorted(report['rows'].items())])
+      add("bagapi_rows_per_second", "gauge", "Input rows processed per second.", [({}, report['rows_per_second'])])
+
+      add_histogram("bagapi_http_request_duration_seconds", "Latency of api requests.", [({'api': api, 'endpoint': endpoint}, metrics.latency) for (api, endpoint), metrics in requests])
+      add("bagapi_http_responses_total", "counter", "Api responses, by status code.", [({'api': api, 'endpoint': endpoint, 'code': status_code}, count) for (api, endpoint), metrics in requests for status_code, count in sorted(metrics.status_codes.items())])
+      add("bagapi_http_request_bytes_total", "counter", "Bytes sent to the api's.", [({'api': api, 'endpoint': endpoint}, metrics.bytes_sent) for (api, endpoint), metrics in requests])
+      add("bagapi_http_response_bytes_total", "counter", "Bytes received from the api's.", [({'api': api, 'endpoint': endpoint}, metrics.bytes_received) for (api, endpoint), metrics in requests])
+      add("bagapi_http_retries_total", "counter", "Api requests that were retried.", [({'api': api, 'endpoint': endpoint}, metrics.retries) for (api, endpoint), metrics in requests])
+      add("bagapi_cache_hits_total", "counter", "Api requests answered by the cache.", [({'api': api, 'endpoint': endpoint}, metrics.cached) for (api, endpoint), metrics in requests])
+
+      add_histogram("bagapi_phase_duration_seconds", "Duration of the phases of a row.", [({'phase': phase}, metrics.latency) for phase, metrics in phases])
+      add("bagapi_phase_cpu_seconds_total", "counter", "Cpu time used by the phases of a row.", [({'phase': phase}, metrics.cpu_seconds) for phase, metrics in phases])
+
+    return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+
+  if len(labels) == 0:
+    return ""
+
+  escaped = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return "{" + ",".join('{0}="{1}"'.format(name, escaped(value)) for name, value in labels.items()) + "}"
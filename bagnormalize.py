@@ -0,0 +1,96 @@
+# ==================================================================================
+#                                 INPUT NORMALIZATION
+# ==================================================================================
+
+# The same address is written in many ways in input.csv: "1012 ab" or
+# "1012AB", with stray spaces, "12a" as huisnummer. Every row is normalized
+# before anything is looked up, so rows with the same address have the same
+# key (see get_address_key in bagenrich.py) and share one lookup:
+#
+# - postcode: without spaces, in capitals
+# - huisnummer: without spaces and leading zeros. With a postcode, a letter
+#   or toevoeging stuck to it ("12a", "12-2") is moved to its own column,
+#   when that column is empty (the text search of rows without a postcode
+#   understands them as they are).
+# - huisletter: without spaces, in capitals
+# - huisnummertoevoeging: without spaces and dashes around it
+# - straat and stad: without double spaces
+#
+# A single letter in huisnummertoevoeging is left alone, it can really be a
+# toevoeging (like the H of many Amsterdam addresses). When such an address
+# is not found, it is searched again with the letter as huisletter (see
+# swap_huisletter).
+
+import re
+
+# 12a, 12 a, 12-2, 12a-2, 12 a bis
+HUISNUMMER_PATTERN = re.compile(r'^(\d+)\s*([A-Za-z](?![A-Za-z0-9]))?\s*[-/]?\s*([A-Za-z0-9]{1,4})?$')
+
+# Columns of input.csv that are used, a row without one of them has it empty
+INPUT_COLUMNS = ('postcode', 'huisnummer', 'huisletter', 'huisnummertoevoeging', 'straat', 'stad')
+
+def normalize_text(value):
+
+  return " ".join(str(value).split())
+
+def normalize_postcode(value):
+
+  return "".join(str(value).split()).upper()
+
+def normalize_row(row):
+
+  # The normalized row, and whether the text of one of its columns changed.
+  # Values become text (rows sent to the service can have numbers).
+  normalized = dict(row)
+  for name in INPUT_COLUMNS:
+    value = row.get(name)
+    normalized[name] = "" if value is None else str(value)
+  given = {name: normalized[name] for name in INPUT_COLUMNS}
+
+  normalized['postcode'] = normalize_postcode(normalized['postcode'])
+  normalized['straat'] = normalize_text(normalized['straat'])
+  normalized['stad'] = normalize_text(normalized['stad'])
+  normalized['huisletter'] = normalized['huisletter'].strip().upper()
+  normalized['huisnummertoevoeging'] = normalized['huisnummertoevoeging'].strip(" -")
+
+  huisnummer = normalized['huisnummer'].strip()
+  match = HUISNUMMER_PATTERN.match(huisnummer)
+
+  if match is not None:
+    number, huisletter, huisnummertoevoeging = match.groups()
+
+    # Only split when the row has a postcode, and the columns are free
+    if huisletter is None and huisnummertoevoeging is None:
+      huisnummer = str(int(number))
+    elif normalized['postcode'] != "" \
+      and (huisletter is None or normalized['huisletter'] == "") \
+      and (huisnummertoevoeging is None or normalized['huisnummertoevoeging'] == ""):
+
+      huisnummer = str(int(number))
+      if huisletter is not None:
+        normalized['huisletter'] = huisletter.upper()
+      if huisnummertoevoeging is not None:
+        normalized['huisnummertoevoeging'] = huisnummertoevoeging
+
+  normalized['huisnummer'] = huisnummer
+
+  return normalized, any(normalized[name] != given[name] for name in INPUT_COLUMNS)
+
+def swap_huisletter(params):
+
+  # Search params with a single letter moved from huisnummertoevoeging to
+  # huisletter (or the other way around), None when that does not apply
+  huisletter = params.get('huisletter', '')
+  huisnummertoevoeging = params.get('huisnummertoevoeging', '')
+
+  swapped = dict(params)
+  if huisletter == "" and len(huisnummertoevoeging) == 1 and huisnummertoevoeging.isalpha():
+    del swapped['huisnummertoevoeging']
+    swapped['huisletter'] = huisnummertoevoeging.upper()
+  elif huisnummertoevoeging == "" and len(huisletter) == 1:
+    del swapped['huisletter']
+    swapped['huisnummertoevoeging'] = huisletter
+  else:
+    return None
+
+  return swapped
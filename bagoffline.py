@@ -0,0 +1,397 @@
+# ==================================================================================
+#                                 OFFLINE BAG EXTRACT
+# ==================================================================================
+
+# For really big jobs it is a lot faster to look everything up in a local copy
+# of the BAG than to ask the api for every address. This file does two things:
+#
+# 1. Import an export of the BAG (nummeraanduidingen, verblijfsobjecten and
+#    panden, as CSV files) into an indexed SQLite database:
+#
+#      python bagoffline.py bag_extract.sqlite --nummeraanduiding nummeraanduiding.csv --verblijfsobject verblijfsobject.csv --pand pand.csv
+#
+#    Importing again (for example the extract of next month) only updates the
+#    objects that are in the files, nothing is rebuilt. A file that has been
+#    imported before is skipped. Objects with "true" in a "verwijderd" column
+#    are removed.
+#
+# 2. Answer the requests of bagapi.py from that database, when offline_extract
+#    is set in config.py. The answers look exactly like the ones of the api, so
+#    the output is the same as when using the api.
+#
+# Columns of the CSV files:
+#
+# - nummeraanduiding: identificatie, postcode, huisnummer, huisletter,
+#   huisnummertoevoeging, openbareruimte, woonplaats, verblijfsobject
+# - verblijfsobject: identificatie, oppervlakte, gebruiksdoel, status, pand,
+#   hoofdadres (more gebruiksdoelen or panden are separated by a |)
+# - pand: identificatie, bouwjaar
+
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from bagcache import CachedResponse
+from bagjournal import fingerprint_file
+
+# Rows written to the database in one go while importing
+IMPORT_BATCH_SIZE = 10000
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS nummeraanduiding (
+    identificatie TEXT PRIMARY KEY,
+    postcode TEXT,
+    huisnummer INTEGER,
+    huisletter TEXT,
+    huisnummertoevoeging TEXT,
+    openbareruimte TEXT,
+    woonplaats TEXT,
+    verblijfsobject TEXT
+  );
+  CREATE INDEX IF NOT EXISTS nummeraanduiding_postcode ON nummeraanduiding (postcode, huisnummer);
+  CREATE INDEX IF NOT EXISTS nummeraanduiding_straat ON nummeraanduiding (openbareruimte COLLATE NOCASE, huisnummer);
+
+  CREATE TABLE IF NOT EXISTS verblijfsobject (
+    identificatie TEXT PRIMARY KEY,
+    oppervlakte INTEGER,
+    gebruiksdoelen TEXT,
+    status TEXT,
+    hoofdadres TEXT
+  );
+
+  CREATE TABLE IF NOT EXISTS verblijfsobject_pand (
+    pand TEXT,
+    verblijfsobject TEXT,
+    volgorde INTEGER,
+    PRIMARY KEY (pand, verblijfsobject)
+  );
+  CREATE INDEX IF NOT EXISTS verblijfsobject_pand_verblijfsobject ON verblijfsobject_pand (verblijfsobject);
+
+  CREATE TABLE IF NOT EXISTS pand (
+    identificatie TEXT PRIMARY KEY,
+    bouwjaar TEXT
+  );
+
+  CREATE TABLE IF NOT EXISTS imports (
+    fingerprint TEXT PRIMARY KEY,
+    filename TEXT,
+    kind TEXT,
+    imported REAL,
+    rows INTEGER
+  );
+"""
+
+def to_int(value):
+
+  # Numbers stay numbers, like in the answers of the api
+  value = (value or "").strip()
+  return int(value) if value.isdigit() else value
+
+class BagExtract:
+
+  def __init__(self, filename):
+
+    self.filename = filename
+
+    # Every thread gets its own connection
+    self.local = threading.local()
+
+    db = self.connect()
+    db.executescript(SCHEMA)
+
+  def connect(self):
+
+    if getattr(self.local, 'db', None) is None:
+      self.local.db = sqlite3.connect(self.filename)
+      self.local.db.row_factory = sqlite3.Row
+
+    return self.local.db
+
+  # ==================================================================================
+  #                                      IMPORT
+  # ==================================================================================
+
+  def import_file(self, kind, filename, delimiter):
+
+    db = self.connect()
+
+    # Files that have been imported before don't change anything
+    fingerprint = fingerprint_file(filename)
+    if db.execute("SELECT 1 FROM imports WHERE fingerprint = ?", (fingerprint,)).fetchone() is not None:
+      return 0
+
+    row_count = 0
+    with open(filename, newline='', encoding='utf-8') as csvfile:
+      reader = csv.DictReader(csvfile, delimiter=delimiter)
+
+      batch = []
+      for row in reader:
+        batch.append(row)
+        if len(batch) >= IMPORT_BATCH_SIZE:
+          row_count += self.import_rows(kind, batch)
+          batch = []
+      row_count += self.import_rows(kind, batch)
+
+    db.execute("INSERT INTO imports VALUES (?, ?, ?, ?, ?)", (fingerprint, os.path.basename(filename), kind, time.time(), row_count))
+    db.commit()
+
+    return row_count
+
+  def import_rows(self, kind, rows):
+
+    db = self.connect()
+
+    # Removed objects
+    removed = [(row['identificatie'],) for row in rows if row.get('verwijderd', '').strip().lower() == 'true']
+    rows = [row for row in rows if row.get('verwijderd', '').strip().lower() != 'true']
+
+    if kind == 'nummeraanduiding':
+      db.executemany("DELETE FROM nummeraanduiding WHERE identificatie = ?", removed)
+      db.executemany("INSERT OR REPLACE INTO nummeraanduiding VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(
+        row['identificatie'],
+        row['postcode'].replace(' ', '').upper(),
+        to_int(row['huisnummer']),
+        row.get('huisletter', ''),
+        row.get('huisnummertoevoeging', ''),
+        row['openbareruimte'],
+        row['woonplaats'],
+        row['verblijfsobject']
+      ) for row in rows])
+
+    if kind == 'verblijfsobject':
+
+      # The panden of a verblijfsobject are replaced as a whole
+      db.executemany("DELETE FROM verblijfsobject WHERE identificatie = ?", removed)
+      db.executemany("DELETE FROM verblijfsobject_pand WHERE verblijfsobject = ?", removed + [(row['identificatie'],) for row in rows])
+
+      db.executemany("INSERT OR REPLACE INTO verblijfsobject VALUES (?, ?, ?, ?, ?)", [(
+        row['identificatie'],
+        to_int(row['oppervlakte']),
+        json.dumps([gebruiksdoel for gebruiksdoel in row['gebruiksdoel'].split('|') if gebruiksdoel != ""]),
+        row['status'],
+        row['hoofdadres']
+      ) for row in rows])
+      db.executemany("INSERT OR REPLACE INTO verblijfsobject_pand VALUES (?, ?, ?)", [
+        (pand, row['identificatie'], volgorde)
+        for row in rows
+        for volgorde, pand in enumerate(row['pand'].split('|')) if pand != ""
+      ])
+
+    if kind == 'pand':
+      db.executemany("DELETE FROM pand WHERE identificatie = ?", removed)
+      db.executemany("INSERT OR REPLACE INTO pand VALUES (?, ?)", [(row['identificatie'], row['bouwjaar']) for row in rows])
+
+    db.commit()
+
+    return len(rows) + len(removed)
+
+  # ==================================================================================
+  #                                      LOOKUP
+  # ==================================================================================
+
+  def find_addresses(self, postcode=None, huisnummer=None, straat=None, woonplaats=None):
+
+    db = self.connect()
+
+    if postcode is not None and huisnummer is None:
+      return db.execute("SELECT * FROM nummeraanduiding WHERE postcode = ? ORDER BY huisnummer, huisletter, huisnummertoevoeging, identificatie", (postcode,)).fetchall()
+
+    if postcode is not None:
+      return db.execute("SELECT * FROM nummeraanduiding WHERE postcode = ? AND huisnummer = ? ORDER BY huisletter, huisnummertoevoeging, identificatie", (postcode, huisnummer)).fetchall()
+
+    return db.execute(
+      "SELECT * FROM nummeraanduiding WHERE openbareruimte = ? COLLATE NOCASE AND huisnummer = ? AND woonplaats = ? COLLATE NOCASE ORDER BY huisletter, huisnummertoevoeging, identificatie",
+      (straat, huisnummer, woonplaats)
+    ).fetchall()
+
+  def find_panden(self, verblijfsobject):
+
+    db = self.connect()
+    return [row['pand'] for row in db.execute("SELECT pand FROM verblijfsobject_pand WHERE verblijfsobject = ? ORDER BY volgorde", (verblijfsobject,))]
+
+  def find_pand(self, pandId):
+
+    db = self.connect()
+    return db.execute("SELECT * FROM pand WHERE identificatie = ?", (pandId,)).fetchone()
+
+  def find_verblijfsobjecten(self, pandId, limit, offset):
+
+    db = self.connect()
+    return db.execute("""
+      SELECT verblijfsobject.*, nummeraanduiding.postcode, nummeraanduiding.huisnummer, nummeraanduiding.huisletter, nummeraanduiding.huisnummertoevoeging
+      FROM verblijfsobject_pand
+      JOIN verblijfsobject ON verblijfsobject.identificatie = verblijfsobject_pand.verblijfsobject
+      LEFT JOIN nummeraanduiding ON nummeraanduiding.identificatie = verblijfsobject.hoofdadres
+      WHERE verblijfsobject_pand.pand = ?
+      ORDER BY verblijfsobject.identificatie
+      LIMIT ? OFFSET ?
+    """, (pandId, limit, offset)).fetchall()
+
+# ==================================================================================
+#                                  OFFLINE CLIENT
+# ==================================================================================
+
+class OfflineClient:
+
+  # Takes the place of the ApiClient of the BAG api in bagapi.py
+  def __init__(self, extract, base_url):
+
+    self.extract = extract
+    self.base_url = base_url
+    self.name = "BAG extract"
+
+    self.request_count = 0
+    self.lock = threading.Lock()
+
+  def get(self, url, params=None, endpoint=None):
+
+    with self.lock:
+      self.request_count += 1
+
+    params = params or {}
+
+    if endpoint == 'adressen':
+      return self.get_adressen(params)
+    if endpoint == 'panden':
+      return self.get_pand(url.rstrip('/').split('/')[-1])
+    if endpoint == 'verblijfsobjecten':
+      return self.get_verblijfsobjecten(params)
+
+    return self.respond(404, {'title': "Not available in the BAG extract: {0}".format(url)})
+
+  def respond(self, status_code, data):
+
+    return CachedResponse(status_code, json.dumps(data))
+
+  def make_adres(self, row):
+
+    adres = {
+      'korteNaam': row['openbareruimte'],
+      'huisnummer': row['huisnummer'],
+      'woonplaatsNaam': row['woonplaats'],
+      'postcode': row['postcode'],
+      'nummeraanduidingIdentificatie': row['identificatie'],
+      'pandIdentificaties': self.extract.find_panden(row['verblijfsobject']),
+    }
+
+    # Like the api, only give huisletter and huisnummertoevoeging when there is one
+    if row['huisletter']:
+      adres['huisletter'] = row['huisletter']
+    if row['huisnummertoevoeging']:
+      adres['huisnummertoevoeging'] = row['huisnummertoevoeging']
+
+    adres['_links'] = {'panden': [{'href': self.base_url + "panden/" + pandId} for pandId in adres['pandIdentificaties']]}
+
+    return adres
+
+  def get_adressen(self, params):
+
+    if 'q' in params:
+
+      # Search query is "straat huisnummer[toevoeging], stad"
+      match = re.match(r'^\s*(.*?)\s+(\d+)\s*(\S*)\s*,\s*(.*?)\s*$', params['q'])
+      if match is None:
+        return self.respond(200, {})
+
+      rows = self.extract.find_addresses(straat=match.group(1), huisnummer=int(match.group(2)), woonplaats=match.group(4))
+
+      # Prefer the address with the same toevoeging, like the api does
+      toevoeging = match.group(3).lower()
+      rows = sorted(rows, key=lambda row: (row['huisletter'] + row['huisnummertoevoeging']).lower() != toevoeging)
+
+    else:
+
+      postcode = params['postcode'].replace(' ', '').upper()
+      huisnummer = params.get('huisnummer')
+      if huisnummer is not None:
+        huisnummer = to_int(str(huisnummer))
+
+      rows = self.extract.find_addresses(postcode=postcode, huisnummer=huisnummer)
+
+      # exacteMatch: huisletter and huisnummertoevoeging have to be the same
+      if params.get('exacteMatch') == 'true':
+        rows = [row for row in rows
+          if row['huisletter'].lower() == params.get('huisletter', '').lower()
+          and row['huisnummertoevoeging'].lower() == params.get('huisnummertoevoeging', '').lower()]
+
+      # Pages, like the api
+      page_size = int(params.get('pageSize', 20))
+      page = int(params.get('page', 1))
+      rows = rows[(page - 1) * page_size:page * page_size]
+
+    # No results, no _embedded column
+    if len(rows) == 0:
+      return self.respond(200, {})
+
+    return self.respond(200, {'_embedded': {'adressen': [self.make_adres(row) for row in rows]}})
+
+  def get_pand(self, pandId):
+
+    row = self.extract.find_pand(pandId)
+    if row is None:
+      return self.respond(404, {'title': "Pand {0} is not in the BAG extract".format(pandId)})
+
+    return self.respond(200, {'pand': {'identificatie': row['identificatie'], 'oorspronkelijkBouwjaar': row['bouwjaar']}})
+
+  def get_verblijfsobjecten(self, params):
+
+    page_size = int(params.get('pageSize', 20))
+    page = int(params.get('page', 1))
+    rows = self.extract.find_verblijfsobjecten(params['pandIdentificatie'], page_size, (page - 1) * page_size)
+
+    # No more verblijfsobjecten, no _embedded column
+    if len(rows) == 0:
+      return self.respond(200, {})
+
+    verblijfsobjecten = []
+    for row in rows:
+
+      nummeraanduiding = {'postcode': row['postcode'], 'huisnummer': row['huisnummer']}
+      if row['huisletter']:
+        nummeraanduiding['huisletter'] = row['huisletter']
+      if row['huisnummertoevoeging']:
+        nummeraanduiding['huisnummertoevoeging'] = row['huisnummertoevoeging']
+
+      verblijfsobjecten.append({
+        'verblijfsobject': {
+          'identificatie': row['identificatie'],
+          'oppervlakte': row['oppervlakte'],
+          'gebruiksdoelen': json.loads(row['gebruiksdoelen']),
+          'status': row['status']
+        },
+        '_embedded': {'heeftAlsHoofdAdres': {'nummeraanduiding': nummeraanduiding}}
+      })
+
+    return self.respond(200, {'_embedded': {'verblijfsobjecten': verblijfsobjecten}})
+
+  def summary(self):
+
+    return "{0}: {1} lookups in {2}".format(self.name, self.request_count, self.extract.filename)
+
+# ==================================================================================
+#                                   IMPORT COMMAND
+# ==================================================================================
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description="Imports (or updates) a BAG extract into a local database for offline lookups.")
+  parser.add_argument('database', help="the SQLite database to create or update, like bag_extract.sqlite")
+  parser.add_argument('--nummeraanduiding', action='append', default=[], help="CSV file with nummeraanduidingen")
+  parser.add_argument('--verblijfsobject', action='append', default=[], help="CSV file with verblijfsobjecten")
+  parser.add_argument('--pand', action='append', default=[], help="CSV file with panden")
+  parser.add_argument('--delimiter', default=",", help="delimiter character of the CSV files")
+  args = parser.parse_args()
+
+  extract = BagExtract(args.database)
+
+  for kind in ['nummeraanduiding', 'verblijfsobject', 'pand']:
+    for filename in getattr(args, kind):
+      row_count = extract.import_file(kind, filename, args.delimiter)
+      if row_count == 0:
+        print("{0}: already imported, skipped".format(filename))
+      else:
+        print("{0}: imported {1} {2} rows".format(filename, row_count, kind))
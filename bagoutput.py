@@ -0,0 +1,392 @@
+# ==================================================================================
+#                                  OUTPUT WRITERS
+# ==================================================================================
+
+# Output rows can be written as:
+#
+# - csv: output.csv, every value as text (like it always was)
+# - jsonl: output.jsonl, one JSON object per row with typed values, written as
+#   soon as the row is done
+# - parquet: output.parquet, typed columns written in row groups (needs the
+#   pyarrow package)
+#
+# The types come from SCHEMA. With a partition column (for example
+# 'woonplaats') the output becomes a folder with a folder per value, like
+# output/woonplaats=Utrecht/part-00000.parquet, which warehouses can load as
+# one table.
+#
+# Rows can get is_invoer turned on after they are written. patch_invoer()
+# fixes those at the end, by copying the files they are in.
+
+import csv
+import json
+import os
+import shutil
+from array import array
+from collections import OrderedDict
+from urllib.parse import quote
+
+# Columns of the output and their types
+SCHEMA = [
+  ('postcode', 'string'),
+  ('huisnummer', 'int'),
+  ('huisletter', 'string'),
+  ('huisnummertoevoeging', 'string'),
+  ('straat', 'string'),
+  ('woonplaats', 'string'),
+  ('pandId', 'string'),
+  ('bouwjaar', 'int'),
+  ('verblijfsobjectId', 'string'),
+  ('oppervlakte', 'int'),
+  ('gebruiksdoel', 'string'),
+  ('status', 'string'),
+  ('is_invoer', 'bool'),
+  ('sectie', 'string'),
+  ('perceelnummer', 'string'),
+  ('perceeloppervlakte', 'float'),
+  ('perceelomschrijving', 'string'),
+  ('perceel_energielabel', 'string')
+]
+
+OUTPUT_FORMATS = ['csv', 'jsonl', 'parquet']
+
+def to_type(value, kind):
+
+  # Empty values stay empty for text, and become null for the other types
+  if kind == 'string':
+    return "" if value is None else str(value)
+  if value is None or value == "":
+    return None
+
+  try:
+    if kind == 'int':
+      return int(value)
+    if kind == 'float':
+      return float(value)
+  except ValueError:
+    return None
+
+  # Booleans read back from csv are text
+  if isinstance(value, str):
+    return value == 'True'
+  return bool(value)
+
+def typed_row(row):
+
+  return {name: to_type(row.get(name), kind) for name, kind in SCHEMA}
+
+def arrow_schema():
+
+  import pyarrow
+
+  types = {'string': pyarrow.string(), 'int': pyarrow.int64(), 'float': pyarrow.float64(), 'bool': pyarrow.bool_()}
+  return pyarrow.schema([(name, types[kind]) for name, kind in SCHEMA])
+
+# ==================================================================================
+#                                      FILES
+# ==================================================================================
+
+# Every output file is a part. A part knows which output rows it has, so their
+# is_invoer can be fixed later.
+#
+# With many partitions not all their files can be open at the same time. A
+# part that is not used for a while is suspended (its file closed). Csv and
+# JSON Lines parts can be resumed later, a parquet file can't be added to once
+# it is closed, so its partition gets a new part file instead.
+
+class Part:
+
+  # Whether the file can be opened again to add more rows
+  can_resume = True
+
+  def __init__(self, filename, contiguous):
+
+    self.filename = filename
+
+    # Without partitions a part has all rows from the first one on, and
+    # there is no need to remember their numbers
+    self.row_numbers = None if contiguous else array('q')
+    self.first_row_number = None
+    self.row_count = 0
+
+  def add(self, row_number):
+
+    if self.first_row_number is None:
+      self.first_row_number = row_number
+    if self.row_numbers is not None:
+      self.row_numbers.append(row_number)
+    self.row_count += 1
+
+  def get_row_number(self, index):
+
+    if self.row_numbers is None:
+      return self.first_row_number + index
+    return self.row_numbers[index]
+
+  def patched_indexes(self, invoer_patches):
+
+    # Rows of this part that have to get is_invoer
+    return set(index for index in range(self.row_count) if self.get_row_number(index) in invoer_patches)
+
+class CsvPart(Part):
+
+  def __init__(self, filename, contiguous, delimiter):
+
+    Part.__init__(self, filename, contiguous)
+    self.delimiter = delimiter
+    self.file = open(filename, 'w', newline='')
+    self.writer = csv.DictWriter(self.file, fieldnames=[name for name, kind in SCHEMA], extrasaction='ignore', delimiter=delimiter)
+    self.writer.writeheader()
+
+  def resume(self):
+    self.file = open(self.filename, 'a', newline='')
+    self.writer = csv.DictWriter(self.file, fieldnames=[name for name, kind in SCHEMA], extrasaction='ignore', delimiter=self.delimiter)
+
+  def write(self, row):
+    self.writer.writerow(row)
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+  def patch(self, indexes):
+
+    # Copy the file row by row and change those rows along the way
+    with open(self.filename, newline='') as csvfile, open(self.filename + '.tmp', 'w', newline='') as patched_csvfile:
+
+      reader = csv.DictReader(csvfile, delimiter=self.delimiter)
+      writer = csv.DictWriter(patched_csvfile, fieldnames=[name for name, kind in SCHEMA], extrasaction='ignore', delimiter=self.delimiter)
+      writer.writeheader()
+
+      for index, output_row in enumerate(reader):
+        if index in indexes:
+          output_row['is_invoer'] = True
+        writer.writerow(output_row)
+
+    # Put the fixed file in place of the old one
+    os.replace(self.filename + '.tmp', self.filename)
+
+class JsonLinesPart(Part):
+
+  def __init__(self, filename, contiguous):
+
+    Part.__init__(self, filename, contiguous)
+    self.file = open(filename, 'w', encoding='utf-8')
+
+  def resume(self):
+    self.file = open(self.filename, 'a', encoding='utf-8')
+
+  def write(self, row):
+    self.file.write(json.dumps(typed_row(row), ensure_ascii=False) + '\n')
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    self.file.close()
+
+  def patch(self, indexes):
+
+    with open(self.filename, encoding='utf-8') as jsonfile, open(self.filename + '.tmp', 'w', encoding='utf-8') as patched_jsonfile:
+      for index, line in enumerate(jsonfile):
+        if index in indexes:
+          output_row = json.loads(line)
+          output_row['is_invoer'] = True
+          line = json.dumps(output_row, ensure_ascii=False) + '\n'
+        patched_jsonfile.write(line)
+
+    os.replace(self.filename + '.tmp', self.filename)
+
+class ParquetPart(Part):
+
+  can_resume = False
+
+  def __init__(self, filename, contiguous, row_group_size):
+
+    import pyarrow.parquet
+
+    Part.__init__(self, filename, contiguous)
+    self.schema = arrow_schema()
+    self.row_group_size = row_group_size
+    self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+
+    # Rows wait here until there are enough for a row group
+    self.rows = []
+
+  def write(self, row):
+
+    self.rows.append(typed_row(row))
+    if len(self.rows) >= self.row_group_size:
+      self.write_row_group()
+
+  def write_row_group(self):
+
+    import pyarrow
+
+    if len(self.rows) > 0:
+      self.writer.write_table(pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+      self.rows = []
+
+  def flush(self):
+
+    # Row groups are only written when they are full, a small row group
+    # for every input row would make the file slow to read
+    pass
+
+  def close(self):
+
+    self.write_row_group()
+    self.writer.close()
+
+  def patch(self, indexes):
+
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+
+    # Copy the file row group by row group, with is_invoer turned on where needed
+    source = pyarrow.parquet.ParquetFile(self.filename)
+    writer = pyarrow.parquet.ParquetWriter(self.filename + '.tmp', self.schema)
+    offset = 0
+
+    for group in range(source.num_row_groups):
+      table = source.read_row_group(group)
+      mask = pyarrow.array([offset + index in indexes for index in range(table.num_rows)])
+      column = table.schema.get_field_index('is_invoer')
+      table = table.set_column(column, 'is_invoer', pyarrow.compute.if_else(mask, True, table.column('is_invoer')))
+      writer.write_table(table)
+      offset += table.num_rows
+
+    writer.close()
+    os.replace(self.filename + '.tmp', self.filename)
+
+# ==================================================================================
+#                                      WRITER
+# ==================================================================================
+
+class OutputWriter:
+
+  def __init__(self, output_format="csv", delimiter=",", partition_by="", row_group_size=10000, basename="output", max_open_parts=200):
+
+    if output_format not in OUTPUT_FORMATS:
+      raise ValueError("Unknown output format \"{0}\", use one of: {1}".format(output_format, ", ".join(OUTPUT_FORMATS)))
+
+    self.output_format = output_format
+    self.delimiter = delimiter
+    self.partition_by = partition_by
+    self.row_group_size = row_group_size
+    self.basename = basename
+    self.row_count = 0
+
+    # Partitions are folders in the output folder, with parts per value. Only
+    # the parts used last are kept open.
+    self.parts = []
+    self.open_parts = OrderedDict()
+    self.suspended_parts = {}
+    self.part_counts = {}
+    self.max_open_parts = max_open_parts
+
+    # The folder is emptied first, files of an earlier run would be loaded
+    # with the new ones (a resumed run writes all its rows again)
+    if partition_by != "":
+      shutil.rmtree(basename, ignore_errors=True)
+      os.makedirs(basename, exist_ok=True)
+
+    # Check early that parquet can be written, not after the first lookups
+    if output_format == 'parquet':
+      import pyarrow.parquet
+
+  def path(self):
+
+    # What was written, for the log
+    if self.partition_by != "":
+      return self.basename + "/"
+    return "{0}.{1}".format(self.basename, self.output_format)
+
+  def open_part(self, filename, contiguous):
+
+    if self.output_format == 'csv':
+      return CsvPart(filename, contiguous, self.delimiter)
+    if self.output_format == 'jsonl':
+      return JsonLinesPart(filename, contiguous)
+    return ParquetPart(filename, contiguous, self.row_group_size)
+
+  def new_part(self, value):
+
+    if value is None:
+      part = self.open_part(self.path(), True)
+
+    else:
+
+      # Folder names like woonplaats=Den%20Haag, like Hive does
+      folder = os.path.join(self.basename, "{0}={1}".format(self.partition_by, quote(value, safe='')))
+      os.makedirs(folder, exist_ok=True)
+
+      part_number = self.part_counts.get(value, 0)
+      self.part_counts[value] = part_number + 1
+      part = self.open_part(os.path.join(folder, "part-{0:05d}.{1}".format(part_number, self.output_format)), False)
+
+    self.parts.append(part)
+    return part
+
+  def get_part(self, row):
+
+    value = None
+    if self.partition_by != "":
+      value = str(row.get(self.partition_by, "")) or "__empty__"
+
+    part = self.open_parts.get(value)
+    if part is not None:
+      self.open_parts.move_to_end(value)
+      return part
+
+    # Make room by closing the part that was used the longest time ago
+    if len(self.open_parts) >= self.max_open_parts:
+      old_value, old_part = self.open_parts.popitem(last=False)
+      old_part.close()
+      if old_part.can_resume:
+        self.suspended_parts[old_value] = old_part
+
+    part = self.suspended_parts.pop(value, None)
+    if part is not None:
+      part.resume()
+    else:
+      part = self.new_part(value)
+
+    self.open_parts[value] = part
+    return part
+
+  def write(self, row):
+
+    part = self.get_part(row)
+    part.write(row)
+    part.add(self.row_count)
+    self.row_count += 1
+
+  def flush(self):
+
+    for part in self.open_parts.values():
+      part.flush()
+
+  def close(self):
+
+    # Always give a file, also when there are no rows at all
+    if self.partition_by == "" and len(self.parts) == 0:
+      self.open_parts[None] = self.new_part(None)
+
+    for part in self.open_parts.values():
+      part.close()
+    self.open_parts.clear()
+
+  def patch_invoer(self, invoer_patches):
+
+    # Only copy the files that have rows to fix
+    if len(invoer_patches) == 0:
+      return
+
+    for part in self.parts:
+      indexes = part.patched_indexes(invoer_patches)
+      if len(indexes) > 0:
+        part.patch(indexes)
@@ -0,0 +1,159 @@
+# ==================================================================================
+#                                   RATE LIMITER
+# ==================================================================================
+
+# Kadaster only allows a certain amount of requests per api key. When we go
+# over it, the api answers with 429 (Too Many Requests) and often tells us in
+# a Retry-After header how long to wait.
+#
+# All BAG and GOB requests ask the rate limiter for permission first. For every
+# api host it keeps:
+#
+# - A token bucket, so we never send more requests per second than configured
+# - A pause, set by Retry-After, during which no requests are sent at all
+# - A limit on requests in flight, that is halved on every 429 and slowly grows
+#   back while requests go well (additive increase, multiplicative decrease)
+#
+# This way the requests settle on the highest rate the quota allows, instead of
+# rows failing because of a 429.
+
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Seconds to wait after a 429 without Retry-After header
+DEFAULT_RETRY_AFTER = 1.0
+
+def parse_retry_after(value):
+
+  # Retry-After is either a number of seconds, or a date
+  if value is None or value.strip() == "":
+    return None
+
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+
+  try:
+    return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+  except (TypeError, ValueError):
+    return None
+
+class HostLimiter:
+
+  def __init__(self, host, requests_per_second, max_in_flight):
+
+    self.host = host
+    self.max_in_flight = max_in_flight
+
+    # Token bucket (0 is no maximum). It holds a single token, so requests are
+    # spread evenly instead of sent in bursts that could go over the quota.
+    self.rate = requests_per_second
+    self.tokens = 1.0
+    self.tokens_updated = time.monotonic()
+
+    # Start at full speed, a 429 brings it down soon enough
+    self.limit = float(max_in_flight)
+    self.in_flight = 0
+    self.paused_until = 0.0
+
+    # Counters for the run summary
+    self.request_count = 0
+    self.throttled_count = 0
+    self.first_request = None
+    self.last_request = None
+
+    self.condition = threading.Condition()
+
+  def acquire(self):
+
+    with self.condition:
+      while True:
+
+        now = time.monotonic()
+
+        # Told to wait by a Retry-After header
+        if now < self.paused_until:
+          self.condition.wait(self.paused_until - now)
+          continue
+
+        # Too many requests in flight already
+        if self.in_flight >= int(self.limit):
+          self.condition.wait()
+          continue
+
+        # Out of tokens, wait for the next one
+        if self.rate > 0:
+          self.tokens = min(1.0, self.tokens + (now - self.tokens_updated) * self.rate)
+          self.tokens_updated = now
+          if self.tokens < 1:
+            self.condition.wait((1 - self.tokens) / self.rate)
+            continue
+          self.tokens -= 1
+
+        self.in_flight += 1
+        if self.first_request is None:
+          self.first_request = now
+
+        return
+
+  def release(self, throttled=False, retry_after=None):
+
+    with self.condition:
+
+      now = time.monotonic()
+      self.in_flight -= 1
+      self.request_count += 1
+      self.last_request = now
+
+      if throttled:
+        self.throttled_count += 1
+
+        # Only slow down once per pause, a burst of 429s is one signal
+        if now >= self.paused_until:
+          self.limit = max(1.0, self.limit / 2)
+
+        if retry_after is None:
+          retry_after = DEFAULT_RETRY_AFTER
+        self.paused_until = max(self.paused_until, now + retry_after)
+
+      else:
+        # Grow by about one request per round of requests in flight
+        self.limit = min(float(self.max_in_flight), self.limit + 1 / self.limit)
+
+      self.condition.notify_all()
+
+  def requests_per_second(self):
+
+    if self.first_request is None or self.last_request == self.first_request:
+      return 0.0
+
+    return self.request_count / (self.last_request - self.first_request)
+
+  def summary(self):
+
+    return "Rate {0}: {1:.1f} requests/s, settled on {2} requests in flight ({3} times throttled)".format(self.host, self.requests_per_second(), int(self.limit), self.throttled_count)
+
+class RateLimiter:
+
+  def __init__(self, requests_per_second):
+
+    # Maximum requests per second per host, from the configuration
+    self.requests_per_second = requests_per_second
+    self.hosts = {}
+    self.lock = threading.Lock()
+
+  def get(self, host, max_in_flight):
+
+    # Every host gets its own limiter the first time it is used
+    with self.lock:
+      if host not in self.hosts:
+        self.hosts[host] = HostLimiter(host, self.requests_per_second.get(host, 0), max_in_flight)
+
+      return self.hosts[host]
+
+  def summary(self):
+
+    return [self.hosts[host].summary() for host in sorted(self.hosts)]
@@ -0,0 +1,113 @@
+# ==================================================================================
+#                                   OUTPUT ROWS
+# ==================================================================================
+
+# Every verblijfsobject of a pand becomes an output row, and most columns of
+# those rows are the same for the whole pand (straat, woonplaats, pandId,
+# bouwjaar and the perceel). Rows that are kept in memory (pand lookups,
+# the output of a job in the service, the rows of a previous run) are stored
+# per pand instead of as a dict per row:
+#
+# - the pand columns once, in a tuple
+# - a small tuple per verblijfsobject with the other columns, shared by every
+#   row (of every job) at that pand
+# - is_invoer as one byte per row
+#
+# Text that repeats a lot (gebruiksdoel, status, postcode, straat) is interned,
+# so all rows point to the same string. Rows are only made into dicts while
+# they are written.
+
+import sys
+
+PAND_FIELDS = ('straat', 'woonplaats', 'pandId', 'bouwjaar', 'sectie', 'perceelnummer', 'perceeloppervlakte', 'perceelomschrijving', 'perceel_energielabel')
+UNIT_FIELDS = ('postcode', 'huisnummer', 'huisletter', 'huisnummertoevoeging', 'verblijfsobjectId', 'oppervlakte', 'gebruiksdoel', 'status')
+
+def intern(value):
+
+  return sys.intern(value) if isinstance(value, str) else value
+
+def make_pand(straat, woonplaats, pandId, bouwjaar, sectie, perceelnummer, perceeloppervlakte, perceelomschrijving, perceel_energielabel):
+
+  return (intern(straat), intern(woonplaats), pandId, bouwjaar, intern(sectie), perceelnummer, perceeloppervlakte, intern(perceelomschrijving), intern(perceel_energielabel))
+
+def make_unit(postcode, huisnummer, huisletter, huisnummertoevoeging, verblijfsobjectId, oppervlakte, gebruiksdoel, status):
+
+  # The id of a verblijfsobject is never the same, so not worth interning
+  return (intern(postcode), huisnummer, intern(huisletter), intern(huisnummertoevoeging), verblijfsobjectId, oppervlakte, intern(gebruiksdoel), intern(status))
+
+class PandRows:
+
+  __slots__ = ('pand', 'units', 'invoer')
+
+  def __init__(self, pand, units, invoer):
+
+    self.pand = pand
+    self.units = units
+    self.invoer = invoer
+
+  def __len__(self):
+
+    return len(self.units)
+
+  def __iter__(self):
+
+    for index in range(len(self.units)):
+      yield self.row(index)
+
+  def row(self, index):
+
+    output_row = dict(zip(UNIT_FIELDS, self.units[index]))
+    output_row.update(zip(PAND_FIELDS, self.pand))
+    output_row['is_invoer'] = self.invoer[index] == 1
+
+    return output_row
+
+  def with_invoer(self, invoer):
+
+    # The same rows with another is_invoer, nothing is copied
+    return PandRows(self.pand, self.units, invoer)
+
+def as_pand_rows(rows):
+
+  # Rows of a pand as dicts (from a journal) to PandRows
+  if isinstance(rows, PandRows):
+    return rows
+  if len(rows) == 0:
+    return PandRows((), (), b'')
+
+  pand = make_pand(*[rows[0].get(name, "") for name in PAND_FIELDS])
+  units = tuple(make_unit(*[output_row.get(name, "") for name in UNIT_FIELDS]) for output_row in rows)
+  invoer = bytes(output_row.get('is_invoer') in (True, 'True') for output_row in rows)
+
+  return PandRows(pand, units, invoer)
+
+class RowStore:
+
+  # Output rows of a job, in order, with is_invoer fixed by invoer_patches
+  # (output row numbers) when they are read
+
+  def __init__(self):
+
+    self.pand_rows = []
+    self.row_count = 0
+    self.invoer_patches = set()
+
+  def add(self, rows):
+
+    if len(rows) > 0:
+      self.pand_rows.append(as_pand_rows(rows))
+      self.row_count += len(rows)
+
+  def __len__(self):
+
+    return self.row_count
+
+  def __iter__(self):
+
+    output_row_number = 0
+    for pand_rows in self.pand_rows:
+      for output_row in pand_rows:
+        if output_row_number in self.invoer_patches:
+          output_row['is_invoer'] = True
+        output_row_number += 1
+        yield output_row
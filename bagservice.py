@@ -0,0 +1,166 @@
+# ==================================================================================
+#                                     SERVICE
+# ==================================================================================
+
+# Keeps bagapi.py running as a local service, for many small jobs. Starting a
+# new process for every job means new connections (and TLS handshakes), an
+# empty cache and no lookups to share. The service keeps one Enricher for all
+# jobs, so those stay warm.
+#
+# Start it with `bagapi.py --serve` and send it jobs:
+#
+# - POST /enrich with a JSON list of rows (or {"rows": [...]}), gives back
+#   {"rows": [...], "failed": [...], "skipped": [...]} with the output rows and
+#   the (1 based) numbers of the input rows that failed or were skipped
+# - POST /enrich with a csv body (Content-Type: text/csv), gives back csv
+# - GET /metrics gives the measurements of all jobs, for Prometheus
+# - GET /health answers {"status": "ok"}
+#
+# Every job gets its own duplicate check, so the output of a job is the same
+# as when its rows were in input.csv. Only the lookups behind it are shared.
+
+import csv
+import io
+import json
+import logging
+import signal
+import threading
+import time
+from bagenrich import Enricher, fieldnames
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger('bagapi')
+
+class ServiceHandler(BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+
+    log.info("Service: " + format % args)
+
+  def respond(self, status_code, body, content_type='application/json'):
+
+    if content_type == 'application/json':
+      body = json.dumps(body)
+    body = body.encode('utf-8')
+
+    self.send_response(status_code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+
+    enricher = self.server.enricher
+
+    if self.path == '/health':
+      self.respond(200, {'status': "ok"})
+    elif self.path == '/metrics':
+      report = enricher.metrics.report(self.server.row_counts())
+      self.respond(200, enricher.metrics.format_prometheus(report), 'text/plain; version=0.0.4')
+    else:
+      self.respond(404, {'error': "Not found"})
+
+  def do_POST(self):
+
+    if self.path != '/enrich':
+      self.respond(404, {'error': "Not found"})
+      return
+
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+    is_csv = self.headers.get('Content-Type', '').startswith('text/csv')
+    delimiter = getattr(self.server.enricher.config, 'csv_delimiter', ",")
+
+    # Read the rows of the job
+    try:
+      if is_csv:
+        rows = list(csv.DictReader(io.StringIO(body), delimiter=delimiter))
+      else:
+        rows = json.loads(body)
+        if isinstance(rows, dict):
+          rows = rows.get('rows', [])
+    except ValueError as e:
+      self.respond(400, {'error': "Can't read the rows: {0}".format(e)})
+      return
+
+    # Same checks as for input.csv
+    if not isinstance(rows, list) or any(not isinstance(row, dict) or row.get('huisnummer', '') == "" for row in rows):
+      self.respond(400, {'error': "Every row needs a 'huisnummer'"})
+      return
+
+    started = time.perf_counter()
+    try:
+      job = self.server.enricher.enrich_job(rows)
+    except Exception as e:
+
+      # The service keeps running for the next jobs
+      log.exception("Service: job of {0} rows failed".format(len(rows)))
+      self.respond(500, {'error': "The job failed: {0}".format(e)})
+      return
+    self.server.count_job(job, len(rows))
+    log.info("Service: job of {0} rows done in {1:.3f}s".format(len(rows), time.perf_counter() - started))
+
+    if is_csv:
+      output = io.StringIO()
+      writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore', delimiter=delimiter, lineterminator='\n')
+      writer.writeheader()
+      writer.writerows(job.output_rows)
+      self.respond(200, output.getvalue(), 'text/csv')
+    else:
+      self.respond(200, {
+        'rows': list(job.output_rows),
+        'failed': [row_index + 1 for row_index in job.output_failures],
+        'skipped': [row_index + 1 for row_index in job.output_skips]
+      })
+
+class Service(ThreadingHTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self, config, host, port):
+
+    ThreadingHTTPServer.__init__(self, (host, port), ServiceHandler)
+
+    # Pand and perceel lookups are kept for later jobs, the ones used last
+    self.enricher = Enricher(config, lookup_memory=getattr(config, 'lookup_memory', 10000))
+
+    # Row counts of all jobs together, for the metrics
+    self.rows = {'input': 0, 'output': 0, 'failed': 0, 'skipped': 0}
+    self.jobs = 0
+
+  def count_job(self, job, row_count):
+
+    with self.enricher.metrics.lock:
+      self.jobs += 1
+      self.rows['input'] += row_count
+      self.rows['output'] += job.output_row_count
+      self.rows['failed'] += len(job.output_failures)
+      self.rows['skipped'] += len(job.output_skips)
+
+  def row_counts(self):
+
+    with self.enricher.metrics.lock:
+      return dict(self.rows)
+
+def serve(config, host, port):
+
+  service = Service(config, host, port)
+  log.info("Service running at http://{0}:{1}/enrich".format(host, port))
+
+  # Stop nicely when the scheduler stops us (shutdown waits for serve_forever,
+  # so it can't be called from this thread)
+  signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=service.shutdown).start())
+
+  try:
+    service.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    service.server_close()
+    service.enricher.close()
+    log.info("Service stopped after {0} jobs".format(service.jobs))
+    for summary in service.enricher.summary():
+      log.info("- " + summary)
@@ -0,0 +1,155 @@
+# ==================================================================================
+#                                      SHARDS
+# ==================================================================================
+
+# One process with one api key can only go so fast. A big input.csv can be
+# split over shards, done by separate processes or machines:
+#
+#   bagapi.py --shard 1/4    (on every machine the same input.csv, 1 to 4)
+#   bagapi.py --merge 4      (with the journals of all shards next to it)
+#
+# Every row belongs to one shard, decided by a hash of its postcode (or of its
+# street and city when there is no postcode). Addresses at the same pand
+# mostly have the same postcode, so they end up in the same shard and are
+# still skipped there as duplicates.
+#
+# A shard writes its own output and journal (output.shard-1-of-4.csv and
+# output.shard-1-of-4.journal). The journals have the outcome of every row, by
+# its row number in input.csv. The merge goes through input.csv in order and
+# takes the outcome of every row from the journal of its shard. Whether a row
+# is a duplicate is decided again for the whole input, so output.csv (and its
+# is_invoer, failed and skipped rows) is the same as when one process did all
+# rows. A row that was a duplicate in its shard but is the first at its pand
+# in the whole input is looked up again, so the merge uses the api's for
+# those few rows.
+
+import os
+from concurrent.futures import TimeoutError
+from bagnormalize import normalize_postcode, normalize_row, normalize_text
+from bisect import bisect_right
+from zlib import crc32
+
+def parse_shard(text):
+
+  # "2/8" is shard 2 of 8
+  try:
+    shard, shard_count = [int(part) for part in text.split('/')]
+  except ValueError:
+    raise ValueError("A shard is given like 2/8 (shard 2 of 8), not \"{0}\"".format(text))
+
+  if shard_count < 1 or shard < 1 or shard > shard_count:
+    raise ValueError("Shard {0} of {1} does not exist".format(shard, shard_count))
+
+  return shard, shard_count
+
+def get_shard(row, shard_count):
+
+  # The same on every machine and python version (unlike hash()), and for
+  # the row before and after it is normalized
+  postcode = normalize_postcode(row.get('postcode', ''))
+  if postcode != "":
+    key = postcode
+  else:
+    key = "{0}, {1}".format(normalize_text(row.get('straat', '')), normalize_text(row.get('stad', ''))).lower()
+
+  return crc32(key.encode('utf-8')) % shard_count + 1
+
+def shard_filename(filename, shard, shard_count):
+
+  # output.journal becomes output.shard-2-of-8.journal
+  root, extension = os.path.splitext(filename)
+  return "{0}.shard-{1}-of-{2}{3}".format(root, shard, shard_count, extension)
+
+class ShardMerge:
+
+  def __init__(self, job):
+
+    # The job of the merged output, it does the bookkeeping of the whole input
+    self.job = job
+
+    # Skips in a shard point to an output row of that shard. The output rows
+    # of every shard are numbered here, with the pand they belong to.
+    self.shard_rows = {}
+
+  def add_shard_rows(self, shard, outcome):
+
+    row_starts, pandIds, row_count = self.shard_rows.get(shard, ([], [], 0))
+    row_starts.append(row_count)
+    pandIds.append(outcome['pandId'])
+    self.shard_rows[shard] = (row_starts, pandIds, row_count + len(outcome['rows']))
+
+  def get_shard_pand(self, shard, output_row_number):
+
+    row_starts, pandIds, row_count = self.shard_rows[shard]
+    return pandIds[bisect_right(row_starts, output_row_number) - 1]
+
+  def merge(self, shard, outcome, row):
+
+    # Outcome of the row for the whole input, from its outcome in the shard
+    if outcome['outcome'] == 'rows':
+      self.add_shard_rows(shard, outcome)
+
+    # Skipped in the shard, the pand is the one of the row it was a duplicate of
+    pandId = outcome.get('pandId')
+    if outcome['outcome'] == 'skip' and outcome['reason'] == 'address':
+      pandId = self.get_shard_pand(shard, outcome['invoer'])
+
+    # A skip in the shard can be the first row at its pand in the whole input,
+    # when the row it was a duplicate of is a duplicate itself there. That
+    # row is looked up again, for the perceel of its own address.
+    merged = self.job.reuse_outcome(dict(outcome, pandId=pandId), row)
+    if merged is None:
+      try:
+        merged = self.job.look_up_again(outcome['row'], row)
+      except TimeoutError:
+
+        # Tried again when all rows are merged, like a run does
+        merged = self.job.defer_row(outcome['row'], row, False)
+
+    return merged
+
+def merge_shards(job, rows, journals, on_outcome=None):
+
+  # journals are the RunJournals of the shards, by shard number, rows are the
+  # rows of input.csv. Every outcome is given to on_outcome, like a run does.
+  merger = ShardMerge(job)
+  shard_count = len(journals)
+  outcomes = {shard: journal.replay() for shard, journal in journals.items()}
+
+  # Rows a shard tried again at its end, their outcome comes after all rows
+  retry_rows = {}
+
+  def merge_outcome(shard, outcome, row):
+    merged = merger.merge(shard, outcome, row) if outcome['outcome'] != 'retry' else dict(outcome)
+    job.apply_outcome(merged)
+    if on_outcome is not None:
+      on_outcome(merged)
+
+  for row_index, row in enumerate(rows):
+
+    # Like the shards saw it
+    row = normalize_row(row)[0]
+
+    shard = get_shard(row, shard_count)
+    outcome = next(outcomes[shard], None)
+    if outcome is None or outcome['row'] != row_index:
+      raise ValueError("shard {0} of {1} is not finished (row {2} is missing), resume it first".format(shard, shard_count, row_index + 1))
+
+    if outcome['outcome'] == 'retry':
+      retry_rows[(shard, row_index)] = row
+    merge_outcome(shard, outcome, row)
+
+  # The rows that were tried again, in the order of their shard
+  for shard in sorted(outcomes.keys()):
+    for outcome in outcomes[shard]:
+      row = retry_rows.pop((shard, outcome['row']), None)
+      if row is None:
+        raise ValueError("the journal of shard {0} of {1} has row {2} twice".format(shard, shard_count, outcome['row'] + 1))
+      merge_outcome(shard, outcome, row)
+
+  if len(retry_rows) > 0:
+    shard, row_index = min(retry_rows.keys())
+    raise ValueError("shard {0} of {1} is not finished (row {2} is missing), resume it first".format(shard, shard_count, row_index + 1))
+
+  # Rows that were looked up again during the merge, and took too long
+  job.retry_deferred_rows(on_outcome)
@@ -0,0 +1,184 @@
+# ==================================================================================
+#                                    BENCHMARK
+# ==================================================================================
+
+# Measures how fast bagapi.py gets through inputs of different sizes, against
+# the mock api in mockserver.py. For every size it:
+#
+# - Makes an input.csv with addresses of the mock data (some duplicates, some
+#   without postcode and some that don't exist, like a real input)
+# - Runs bagapi.py on it in a temporary folder, with its own config.py
+# - Reports rows per second, the latency per endpoint (p50/p95/p99, measured by
+#   the mock api) and the peak memory (RSS) of bagapi.py
+#
+# Example, from the folder of bagapi.py:
+#
+#   python benchmark/benchmark.py --rows 100 1000 10000 --workers 8
+#   python benchmark/benchmark.py --rows 1000 --set batch_postcodes=True --set skip_perceel=True
+#   python benchmark/benchmark.py --rows 1000000 --latency 0 --keep
+#
+# The mock api runs in this process, so its latency is not slowed down by
+# bagapi.py using the cpu.
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen, Request
+
+from mockserver import Dataset, MockServer, BAG_PATH, GOB_PATH, add_arguments, settings_from_arguments
+
+BAGAPI_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bagapi.py")
+
+ENDPOINTS = ['adressen', 'panden', 'verblijfsobjecten', 'report']
+
+def make_input(filename, rows, dataset, seed):
+
+  random_generator = random.Random(seed)
+
+  with open(filename, 'w', newline='', encoding='utf-8') as input_file:
+    input_file.write("postcode,huisnummer,huisletter,huisnummertoevoeging,straat,stad\n")
+    for i in range(rows):
+      row = dataset.input_row(random_generator)
+      input_file.write("{postcode},{huisnummer},{huisletter},{huisnummertoevoeging},{straat},{stad}\n".format(**row))
+
+def dataset_postcodes(rows, duplicates, panden_per_postcode=4):
+
+  # The smaller the dataset compared to the input, the more rows end up in a
+  # pand that was looked up before. When n rows pick from m panden, about
+  # m * (1 - e^(-n/m)) different panden are picked: find the m that leaves the
+  # asked fraction of duplicates.
+  if duplicates <= 0:
+    return rows
+
+  low, high = 1.0, float(rows) * 1000
+  for i in range(100):
+    panden = (low + high) / 2
+    unique = panden * (1 - math.exp(-rows / panden)) / rows
+    if unique < 1 - duplicates:
+      low = panden
+    else:
+      high = panden
+
+  return max(1, int(panden / panden_per_postcode))
+
+def make_config(filename, server_url, args):
+
+  # Everything the benchmark does not set stays at the defaults of bagapi.py.
+  # The GOB api gets another host name, so it is rate limited on its own.
+  settings = {
+    'api_base_url': server_url + BAG_PATH,
+    'api_key': "benchmark",
+    'gob_api_base_url': server_url.replace("127.0.0.1", "localhost") + GOB_PATH,
+    'gob_api_key': "benchmark",
+    'csv_delimiter': ",",
+    'skip_perceel': False,
+    'workers': args.workers,
+    'cache_file': "",
+  }
+
+  with open(filename, 'w', encoding='utf-8') as config_file:
+    for name, value in settings.items():
+      config_file.write("{0} = {1!r}\n".format(name, value))
+
+    # Settings from --set are written as given, so they can be any python value
+    for setting in args.set:
+      config_file.write(setting + "\n")
+
+def mock_request(server_url, path):
+
+  with urlopen(Request(server_url + path, method='POST' if path == '/_reset' else 'GET')) as response:
+    return json.loads(response.read())
+
+def run_bagapi(folder):
+
+  # Run it like a user would, from its own folder with its own config.py
+  environment = dict(os.environ, PYTHONPATH=folder)
+  with open(os.path.join(folder, "bagapi.out"), 'w') as output:
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, BAGAPI_FILE], cwd=folder, env=environment, stdout=output, stderr=subprocess.STDOUT)
+
+    # wait4 gives the resource usage of just this process
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    duration = time.monotonic() - started
+
+  # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+  peak_rss = usage.ru_maxrss * 1024 if sys.platform != 'darwin' else usage.ru_maxrss
+
+  return process.returncode, duration, peak_rss
+
+def run_benchmark(server, dataset, rows, args):
+
+  folder = tempfile.mkdtemp(prefix="bagapi-benchmark-")
+  make_input(os.path.join(folder, "input.csv"), rows, dataset, args.seed)
+  make_config(os.path.join(folder, "config.py"), server.url(), args)
+
+  mock_request(server.url(), '/_reset')
+  returncode, duration, peak_rss = run_bagapi(folder)
+  stats = mock_request(server.url(), '/_stats')
+
+  if returncode != 0:
+    print("bagapi.py stopped with exit code {0}, see {1}".format(returncode, os.path.join(folder, "bagapi.out")))
+  elif args.keep:
+    print("Files of this run are kept in {0}".format(folder))
+  else:
+    shutil.rmtree(folder)
+
+  return {
+    'rows': rows,
+    'exit_code': returncode,
+    'seconds': duration,
+    'rows_per_second': rows / duration if duration > 0 else 0.0,
+    'peak_rss_mb': peak_rss / 1024 / 1024,
+    'endpoints': stats['endpoints'],
+    'statuses': stats['statuses']
+  }
+
+def print_result(result):
+
+  print("{0} rows in {1:.1f}s: {2:.1f} rows/s, peak RSS {3:.1f} MB".format(result['rows'], result['seconds'], result['rows_per_second'], result['peak_rss_mb']))
+
+  for endpoint in ENDPOINTS:
+    if endpoint in result['endpoints']:
+      stats = result['endpoints'][endpoint]
+      print("  {0:<18} {1:>8} requests  p50 {2:7.1f}ms  p95 {3:7.1f}ms  p99 {4:7.1f}ms".format(endpoint, stats['requests'], stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
+
+  print("  status codes: {0}".format(", ".join("{0} x{1}".format(status, count) for status, count in sorted(result['statuses'].items()))))
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description="Throughput benchmark of bagapi.py against a local mock api.")
+  parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000], help="input sizes to run")
+  parser.add_argument('--workers', type=int, default=8, help="workers setting of bagapi.py")
+  parser.add_argument('--set', action='append', default=[], metavar="SETTING=VALUE", help="extra config.py line, for example batch_postcodes=True")
+  parser.add_argument('--duplicates', type=float, default=0.3, help="fraction of input rows in a pand that was already looked up")
+  parser.add_argument('--keep', action='store_true', help="keep the folders with the input, output and logs")
+  parser.add_argument('--json', default=None, help="also write the results to this JSON file")
+  add_arguments(parser)
+  args = parser.parse_args()
+
+  server = MockServer(0, None, settings_from_arguments(args))
+  server.start()
+
+  results = []
+  for rows in args.rows:
+
+    postcodes = dataset_postcodes(rows, args.duplicates)
+    server.dataset = Dataset(postcodes=postcodes, big_pand_rate=args.big_pand_rate, big_pand_size=args.big_pand_size, seed=args.seed)
+
+    result = run_benchmark(server, server.dataset, rows, args)
+    print_result(result)
+    results.append(result)
+
+  server.shutdown()
+
+  if args.json is not None:
+    with open(args.json, 'w', encoding='utf-8') as json_file:
+      json.dump(results, json_file, indent=2)
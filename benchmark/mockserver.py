@@ -0,0 +1,532 @@
+# ==================================================================================
+#                                  MOCK BAG/GOB API
+# ==================================================================================
+
+# A local stand-in for the BAG and GOB api's, so bagapi.py can be measured
+# without using the real api's (and our quota). It answers:
+#
+# - GET  .../lvbag/individuelebevragingen/v2/adressen
+# - GET  .../lvbag/individuelebevragingen/v2/panden/<pandIdentificatie>
+# - GET  .../lvbag/individuelebevragingen/v2/verblijfsobjecten (with pageSize/page)
+# - POST .../objectinformatieapi/api/v1/report
+#
+# The data is made up, but always the same for the same settings: every
+# postcode has a few panden, most with one or a few verblijfsobjecten, and
+# some very big ones with thousands.
+#
+# Latency, server errors (503) and throttling (429) can be set, to see how
+# bagapi.py behaves when the api is slow or having a bad day. GET /_stats gives
+# the amount of requests and the latency per endpoint, POST /_reset clears them.
+#
+# Run on its own with:
+#
+#   python benchmark/mockserver.py --port 8765 --latency 0.02
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from hashlib import md5
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+BAG_PATH = "/lvbag/individuelebevragingen/v2/"
+GOB_PATH = "/objectinformatieapi/api/v1/"
+
+# Latencies kept per endpoint for the percentiles, a random sample after that
+LATENCY_SAMPLE_SIZE = 100000
+
+# ==================================================================================
+#                                     DATASET
+# ==================================================================================
+
+class Dataset:
+
+  def __init__(self, postcodes=1000, panden_per_postcode=4, big_pand_rate=0.002, big_pand_size=2000, max_pand_size=40, seed=1):
+
+    self.postcodes = postcodes
+    self.panden_per_postcode = panden_per_postcode
+    self.big_pand_rate = big_pand_rate
+    self.big_pand_size = big_pand_size
+    self.max_pand_size = max_pand_size
+    self.seed = seed
+
+  def number(self, *parts):
+
+    # Same parts give the same (random looking) number
+    return int(md5(repr((self.seed,) + parts).encode()).hexdigest()[:12], 16)
+
+  def postcode(self, p):
+
+    return "{0:04d}{1}{2}".format(1000 + p // 676, chr(65 + (p // 26) % 26), chr(65 + p % 26))
+
+  def postcode_index(self, postcode):
+
+    postcode = postcode.replace(' ', '').upper()
+    if not re.match(r'^\d{4}[A-Z]{2}$', postcode):
+      return None
+
+    p = (int(postcode[:4]) - 1000) * 676 + (ord(postcode[4]) - 65) * 26 + (ord(postcode[5]) - 65)
+    return p if 0 <= p < self.postcodes else None
+
+  def pand_size(self, p, j):
+
+    chance = self.number('size', p, j) % 1000000 / 1000000
+    if chance < self.big_pand_rate:
+      return self.big_pand_size
+
+    # Most panden have a single verblijfsobject
+    if chance < 0.7:
+      return 1
+    return 2 + self.number('units', p, j) % (self.max_pand_size - 1)
+
+  def units(self, p, j):
+
+    # Three verblijfsobjecten per huisnummer: without, with huisletter and
+    # with huisnummertoevoeging
+    return [{
+      'u': u,
+      'huisnummer': j * 10000 + 1 + u // 3,
+      'huisletter': 'A' if u % 3 == 1 else '',
+      'huisnummertoevoeging': 'H' if u % 3 == 2 else ''
+    } for u in range(self.pand_size(p, j))]
+
+  def pand_id(self, p, j):
+    return "0363100{0:09d}".format(p * 10 + j)
+
+  def pand_index(self, pandId):
+    match = re.match(r'^0363100(\d{9})$', pandId)
+    if match is None:
+      return None
+    k = int(match.group(1))
+    return k // 10, k % 10
+
+  def verblijfsobject_id(self, p, j, u):
+    return "0363010{0:08d}{1}{2:04d}".format(p, j, u)
+
+  def nummeraanduiding_id(self, p, j, u):
+    return "0363200{0:08d}{1}{2:04d}".format(p, j, u)
+
+  def street(self, p):
+    return "Straat{0}".format(p)
+
+  def woonplaats(self, p):
+    return "Stad{0}".format(p // 500)
+
+  def adres(self, base_url, p, j, unit):
+
+    adres = {
+      'korteNaam': self.street(p),
+      'huisnummer': unit['huisnummer'],
+      'woonplaatsNaam': self.woonplaats(p),
+      'postcode': self.postcode(p),
+      'nummeraanduidingIdentificatie': self.nummeraanduiding_id(p, j, unit['u']),
+      'pandIdentificaties': [self.pand_id(p, j)],
+      '_links': {'panden': [{'href': base_url + "panden/" + self.pand_id(p, j)}]}
+    }
+    if unit['huisletter']:
+      adres['huisletter'] = unit['huisletter']
+    if unit['huisnummertoevoeging']:
+      adres['huisnummertoevoeging'] = unit['huisnummertoevoeging']
+
+    return adres
+
+  def input_row(self, random_generator):
+
+    # A row like the ones in input.csv, sometimes with a mistake in it
+    p = random_generator.randrange(self.postcodes)
+    j = random_generator.randrange(self.panden_per_postcode)
+    unit = random_generator.choice(self.units(p, j))
+    chance = random_generator.random()
+
+    row = {'postcode': self.postcode(p), 'huisnummer': str(unit['huisnummer']), 'huisletter': unit['huisletter'], 'huisnummertoevoeging': unit['huisnummertoevoeging'], 'straat': '', 'stad': ''}
+
+    # Address that does not exist
+    if chance < 0.02:
+      row.update({'huisnummer': '9999', 'huisletter': '', 'huisnummertoevoeging': ''})
+
+    # No postcode, search on street and city
+    elif chance < 0.07:
+      row.update({'postcode': '', 'straat': self.street(p), 'stad': self.woonplaats(p)})
+
+    return row
+
+# ==================================================================================
+#                                  REQUEST HANDLER
+# ==================================================================================
+
+class MockSettings:
+
+  def __init__(self, latency=0.0, gob_latency=None, jitter=0.0, tail_rate=0.0, tail_latency=1.0, error_rate=0.0, throttle_rate=0.0, quota=0.0, retry_after=1, last_link=True):
+
+    self.latency = latency
+    self.gob_latency = latency * 5 if gob_latency is None else gob_latency
+    self.jitter = jitter
+    self.tail_rate = tail_rate
+    self.tail_latency = tail_latency
+    self.error_rate = error_rate
+    self.throttle_rate = throttle_rate
+    self.quota = quota
+    self.retry_after = retry_after
+    self.last_link = last_link
+
+class MockStats:
+
+  def __init__(self):
+
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+
+    with self.lock:
+      self.requests = {}
+      self.statuses = {}
+      self.latencies = {}
+      self.quota_window = deque()
+
+  def add(self, endpoint, status_code, latency):
+
+    with self.lock:
+      self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+      self.statuses[str(status_code)] = self.statuses.get(str(status_code), 0) + 1
+
+      # Keep a random sample when there are too many
+      latencies = self.latencies.setdefault(endpoint, [])
+      if len(latencies) < LATENCY_SAMPLE_SIZE:
+        latencies.append(latency)
+      else:
+        index = random.randrange(self.requests[endpoint])
+        if index < LATENCY_SAMPLE_SIZE:
+          latencies[index] = latency
+
+  def over_quota(self, quota):
+
+    # Sliding window of one second
+    with self.lock:
+      now = time.monotonic()
+      while len(self.quota_window) > 0 and self.quota_window[0] < now - 1:
+        self.quota_window.popleft()
+      if len(self.quota_window) >= quota:
+        return True
+      self.quota_window.append(now)
+      return False
+
+  def percentile(self, latencies, percent):
+
+    index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+    return latencies[index]
+
+  def report(self):
+
+    with self.lock:
+      endpoints = {}
+      for endpoint, latencies in self.latencies.items():
+        latencies = sorted(latencies)
+        endpoints[endpoint] = {
+          'requests': self.requests[endpoint],
+          'p50': self.percentile(latencies, 50),
+          'p95': self.percentile(latencies, 95),
+          'p99': self.percentile(latencies, 99)
+        }
+
+      return {'endpoints': endpoints, 'statuses': dict(self.statuses)}
+
+class MockHandler(BaseHTTPRequestHandler):
+
+  # Keep connections open, like the real api's. Without Nagle, otherwise the
+  # headers and body go in separate packets that wait for each other.
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+
+    # Quiet, there are way too many requests to log
+    pass
+
+  def respond(self, status_code, data, headers=None):
+
+    body = json.dumps(data).encode('utf-8')
+    self.send_response(status_code)
+    self.send_header('Content-Type', 'application/hal+json')
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+    return status_code
+
+  def do_GET(self):
+
+    self.handle_request('GET')
+
+  def do_POST(self):
+
+    self.handle_request('POST')
+
+  def handle_request(self, method):
+
+    started = time.monotonic()
+    url = urlparse(self.path)
+    params = {name: values[0] for name, values in parse_qs(url.query).items()}
+
+    body = None
+    if method == 'POST':
+      body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+
+    # Control endpoints of the mock itself
+    if url.path == '/_stats':
+      self.respond(200, self.server.stats.report())
+      return
+    if url.path == '/_reset':
+      self.server.stats.reset()
+      self.respond(200, {})
+      return
+
+    endpoint = self.get_endpoint(url.path)
+    settings = self.server.settings
+
+    # Pretend to be busy
+    latency = settings.gob_latency if endpoint == 'report' else settings.latency
+    latency *= random.uniform(1 - settings.jitter, 1 + settings.jitter)
+    if random.random() < settings.tail_rate:
+      latency += settings.tail_latency
+    time.sleep(max(0.0, latency))
+
+    if endpoint is None:
+      status_code = self.respond(404, {'title': "Not found", 'message': "Not found"})
+    elif settings.quota > 0 and self.server.stats.over_quota(settings.quota):
+      status_code = self.respond(429, {'title': "Too many requests", 'message': "Too many requests"}, {'Retry-After': str(settings.retry_after)})
+    elif random.random() < settings.throttle_rate:
+      status_code = self.respond(429, {'title': "Too many requests", 'message': "Too many requests"}, {'Retry-After': str(settings.retry_after)})
+    elif random.random() < settings.error_rate:
+      status_code = self.respond(503, {'title': "Service unavailable", 'message': "Service unavailable"})
+    elif endpoint == 'adressen':
+      status_code = self.respond(200, self.get_adressen(params))
+    elif endpoint == 'panden':
+      status_code = self.respond(*self.get_pand(url.path.split('/')[-1]))
+    elif endpoint == 'verblijfsobjecten':
+      status_code = self.respond(200, self.get_verblijfsobjecten(params))
+    else:
+      status_code = self.respond(200, self.get_report(body))
+
+    if endpoint is not None:
+      self.server.stats.add(endpoint, status_code, time.monotonic() - started)
+
+  def get_endpoint(self, path):
+
+    if path == BAG_PATH + "adressen":
+      return 'adressen'
+    if path.startswith(BAG_PATH + "panden/"):
+      return 'panden'
+    if path == BAG_PATH + "verblijfsobjecten":
+      return 'verblijfsobjecten'
+    if path == GOB_PATH + "report":
+      return 'report'
+
+    return None
+
+  def base_url(self):
+
+    return "http://{0}{1}".format(self.headers['Host'], BAG_PATH)
+
+  def get_links(self, path, params, page, page_count):
+
+    # HAL links to the other pages, like the api
+    def link(to_page):
+      return {'href': "{0}{1}?{2}".format(self.base_url(), path, "&".join("{0}={1}".format(name, to_page if name == 'page' else value) for name, value in sorted(dict(params, page=to_page).items())))}
+
+    links = {'self': link(page), 'first': link(1)}
+    if page > 1:
+      links['prev'] = link(page - 1)
+    if page < page_count:
+      links['next'] = link(page + 1)
+    if self.server.settings.last_link:
+      links['last'] = link(max(1, page_count))
+
+    return links
+
+  def get_adressen(self, params):
+
+    dataset = self.server.dataset
+    found = []
+
+    if 'q' in params:
+
+      # "straat huisnummer[toevoeging], stad", best match first
+      match = re.match(r'^Straat(\d+) (\d+)(\w*)', params['q'])
+      if match is not None and int(match.group(1)) < dataset.postcodes:
+        p = int(match.group(1))
+        for j in range(dataset.panden_per_postcode):
+          found += [(p, j, unit) for unit in dataset.units(p, j) if unit['huisnummer'] == int(match.group(2))]
+        found.sort(key=lambda item: (item[2]['huisletter'] + item[2]['huisnummertoevoeging']).lower() != match.group(3).lower())
+
+    else:
+
+      p = dataset.postcode_index(params.get('postcode', ''))
+      if p is not None:
+        for j in range(dataset.panden_per_postcode):
+          for unit in dataset.units(p, j):
+
+            # Only the given huisnummer, or all addresses of the postcode
+            if 'huisnummer' in params:
+              if str(unit['huisnummer']) != params['huisnummer']:
+                continue
+              if params.get('exacteMatch') == 'true' and (unit['huisletter'] != params.get('huisletter', '').upper() or unit['huisnummertoevoeging'] != params.get('huisnummertoevoeging', '').upper()):
+                continue
+
+            found.append((p, j, unit))
+
+    page_size = int(params.get('pageSize', 20))
+    page = int(params.get('page', 1))
+    page_count = (len(found) + page_size - 1) // page_size
+    found = found[(page - 1) * page_size:page * page_size]
+
+    data = {'_links': self.get_links("adressen", params, page, page_count)}
+    if len(found) > 0:
+      data['_embedded'] = {'adressen': [dataset.adres(self.base_url(), p, j, unit) for p, j, unit in found]}
+
+    return data
+
+  def get_pand(self, pandId):
+
+    dataset = self.server.dataset
+    index = dataset.pand_index(pandId)
+    if index is None or index[0] >= dataset.postcodes:
+      return 404, {'title': "Pand not found"}
+
+    return 200, {'pand': {
+      'identificatie': pandId,
+      'oorspronkelijkBouwjaar': str(1850 + dataset.number('bouwjaar', *index) % 175),
+      'status': "Pand in gebruik"
+    }}
+
+  def get_verblijfsobjecten(self, params):
+
+    dataset = self.server.dataset
+    index = dataset.pand_index(params.get('pandIdentificatie', ''))
+    units = []
+    if index is not None and index[0] < dataset.postcodes:
+      units = dataset.units(*index)
+
+    page_size = int(params.get('pageSize', 20))
+    page = int(params.get('page', 1))
+    page_count = (len(units) + page_size - 1) // page_size
+    units = units[(page - 1) * page_size:page * page_size]
+
+    data = {'_links': self.get_links("verblijfsobjecten", params, page, page_count)}
+    if len(units) > 0:
+      p, j = index
+      verblijfsobjecten = []
+      for unit in units:
+
+        nummeraanduiding = {'postcode': dataset.postcode(p), 'huisnummer': unit['huisnummer']}
+        if unit['huisletter']:
+          nummeraanduiding['huisletter'] = unit['huisletter']
+        if unit['huisnummertoevoeging']:
+          nummeraanduiding['huisnummertoevoeging'] = unit['huisnummertoevoeging']
+
+        verblijfsobjecten.append({
+          'verblijfsobject': {
+            'identificatie': dataset.verblijfsobject_id(p, j, unit['u']),
+            'oppervlakte': 20 + dataset.number('oppervlakte', p, j, unit['u']) % 200,
+            'gebruiksdoelen': ["woonfunctie" if unit['u'] % 5 else "kantoorfunctie"],
+            'status': "Verblijfsobject in gebruik"
+          },
+          '_embedded': {'heeftAlsHoofdAdres': {'nummeraanduiding': nummeraanduiding}}
+        })
+
+      data['_embedded'] = {'verblijfsobjecten': verblijfsobjecten}
+
+    return data
+
+  def get_report(self, body):
+
+    dataset = self.server.dataset
+    number = dataset.number('perceel', (body or {}).get('bagId', ''))
+
+    # Some addresses have no perceel data
+    if number % 20 == 0:
+      return {'document': {}}
+
+    return {'document': {'general': {
+      'kadastraleAanduiding': {'kadastraleAanduiding': "ASD{0:02d} {1} {2}".format(number % 30, chr(65 + number % 26), number % 10000)},
+      'size': str(50 + number % 2000),
+      'omschrijving': "Wonen",
+      'energieLabel': "geen energielabel" if number % 7 == 0 else "ABCDEFG"[number % 7]
+    }}}
+
+# ==================================================================================
+#                                      SERVER
+# ==================================================================================
+
+class MockServer(ThreadingHTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self, port, dataset, settings):
+
+    ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), MockHandler)
+    self.dataset = dataset
+    self.settings = settings
+    self.stats = MockStats()
+
+  def url(self):
+
+    return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+  def start(self):
+
+    # Serve in the background, for the benchmark
+    thread = threading.Thread(target=self.serve_forever, daemon=True)
+    thread.start()
+
+def add_arguments(parser):
+
+  # Settings shared with the benchmark
+  parser.add_argument('--latency', type=float, default=0.02, help="seconds per BAG request")
+  parser.add_argument('--gob-latency', type=float, default=None, help="seconds per GOB request (default 5x the BAG latency)")
+  parser.add_argument('--jitter', type=float, default=0.2, help="random variation of the latency, as a fraction")
+  parser.add_argument('--tail-rate', type=float, default=0.0, help="fraction of requests that are very slow")
+  parser.add_argument('--tail-latency', type=float, default=1.0, help="extra seconds for the very slow requests")
+  parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that get a 503")
+  parser.add_argument('--throttle-rate', type=float, default=0.0, help="fraction of requests that get a 429")
+  parser.add_argument('--quota', type=float, default=0.0, help="requests per second before answering 429 (0 is no quota)")
+  parser.add_argument('--no-last-link', action='store_true', help="leave the 'last' link out of paged responses")
+  parser.add_argument('--big-pand-rate', type=float, default=0.002, help="fraction of panden with --big-pand-size verblijfsobjecten")
+  parser.add_argument('--big-pand-size', type=int, default=2000, help="verblijfsobjecten in a big pand")
+  parser.add_argument('--seed', type=int, default=1, help="seed of the made up data")
+
+def settings_from_arguments(args):
+
+  return MockSettings(
+    latency=args.latency,
+    gob_latency=args.gob_latency,
+    jitter=args.jitter,
+    tail_rate=args.tail_rate,
+    tail_latency=args.tail_latency,
+    error_rate=args.error_rate,
+    throttle_rate=args.throttle_rate,
+    quota=args.quota,
+    last_link=not args.no_last_link
+  )
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(description="Local stand-in for the BAG and GOB api's.")
+  parser.add_argument('--port', type=int, default=8765)
+  parser.add_argument('--postcodes', type=int, default=10000, help="amount of postcodes in the made up data")
+  add_arguments(parser)
+  args = parser.parse_args()
+
+  dataset = Dataset(postcodes=args.postcodes, big_pand_rate=args.big_pand_rate, big_pand_size=args.big_pand_size, seed=args.seed)
+  server = MockServer(args.port, dataset, settings_from_arguments(args))
+
+  print("Mock api running at {0}".format(server.url()))
+  print("- api_base_url = \"{0}{1}\"".format(server.url(), BAG_PATH))
+  print("- gob_api_base_url = \"{0}{1}\"".format(server.url(), GOB_PATH))
+  server.serve_forever()
@@ -10,4 +10,101 @@ gob_api_key = ""
 csv_delimiter=","
 
 # Gob api for perceel information is very slow, skip it?
-skip_perceel = False
\ No newline at end of file
+skip_perceel = False
+
+# Amount of rows that are looked up at the same time
+workers = 8
+
+# Times a request is retried on a server or connection error, and the
+# starting wait in seconds between retries (doubles every retry)
+retries = 3
+retry_backoff = 0.5
+
+# Seconds to wait for a connection and for an answer, per endpoint ('default'
+# is used for the others). A request that gets no answer in time counts as a
+# connection error, and is retried.
+timeouts = {
+  'default': (5, 30),
+  'report': (5, 60)
+}
+
+# Seconds the lookups of a row may take before it is put aside and tried again
+# at the end, with new requests (0 is no limit). The time a row waits for a
+# free worker thread does not count.
+row_deadline = 300
+
+# Endpoints that get a second request when the first one is slower than
+# hedge_percentile of their requests, the first answer is used. This cuts
+# the waits on the odd very slow request, for a few % more requests.
+# For example ['adressen', 'panden', 'report'].
+hedge_endpoints = []
+hedge_percentile = 95
+
+# Api responses are kept in this file, so re-runs over the same addresses
+# don't need the api again. Make it "" to turn the cache off.
+cache_file = "cache.sqlite"
+
+# Days a cached response can be used, per endpoint
+cache_ttl_days = {
+  'adressen': 7,
+  'panden': 30,
+  'verblijfsobjecten': 7,
+  'report': 30
+}
+
+# Maximum size of the cache in MB, the least recently used responses go first
+cache_max_mb = 500
+
+# Every processed row is written to this file, so an interrupted run can be
+# continued with "bagapi.py --resume". Make it "" to turn it off.
+journal_file = "output.journal"
+
+# Look addresses up by getting all addresses of their postcode at once,
+# saves a lot of requests when many rows share a postcode
+batch_postcodes = False
+
+# Amount of perceel reports that are asked to the GOB api at the same time,
+# next to the rows that are looked up in the BAG api
+perceel_workers = 8
+
+# Amount of verblijfsobjecten pages of big panden that are fetched at the same
+# time, once the first page tells how many pages there are
+page_workers = 4
+
+# Maximum requests per second per api host, 0 is no maximum. When the api
+# answers with "429 Too Many Requests" the requests slow down by themselves.
+requests_per_second = {
+  'api.bag.kadaster.nl': 0,
+  'kadatawebservice.kadaster.nl': 0
+}
+
+# Local BAG extract (made with bagoffline.py) to look addresses, panden and
+# verblijfsobjecten up in, instead of the BAG api. "" is use the api.
+offline_extract = ""
+
+# Prometheus textfile with the measurements of the last run, for the textfile
+# collector of node_exporter ("" turns it off). A JSON report of every run is
+# written next to its log file.
+metrics_file = "logs/bagapi.prom"
+
+# Finished pand and perceel lookups the service (bagapi.py --serve) keeps for
+# later jobs, the ones used last. They are forgotten every hour.
+lookup_memory = 10000
+
+# Format of the output: "csv" (output.csv), "jsonl" (output.jsonl, one JSON
+# object per row) or "parquet" (output.parquet, needs the pyarrow package)
+output_format = "csv"
+
+# Column to split the output by, like "woonplaats" ("" is one file). The
+# output then becomes a folder, with a folder for every value. The folder is
+# emptied at the start of every run.
+output_partition = ""
+
+# Rows per row group of a parquet file
+parquet_row_group_size = 10000
+
+# Detail of every Nth row is written to the log (1 is every row, 0 is only
+# the failed rows), and a progress line with rows per second and the time
+# left every so many seconds (0 turns it off)
+log_row_every = 0
+progress_seconds = 10
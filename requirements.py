@@ -1,4 +1,12 @@
 import os
 
 # Install 'requests' package
-os.system('pip install requests')
\ No newline at end of file
+os.system('pip install requests')
+
+# Install 'pyarrow' package, only needed to write parquet output
+try:
+  import config
+  if getattr(config, 'output_format', "csv") == "parquet":
+    os.system('pip install pyarrow')
+except ImportError:
+  pass